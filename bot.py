@@ -1,30 +1,35 @@
+from __future__ import annotations
+
 import asyncio
-import nest_asyncio
+import importlib
 import json
 import os
 import argparse
 from datetime import date
-from typing import List, Dict
+from typing import Awaitable, Callable, List, Dict, Tuple, TYPE_CHECKING
 import time
 
-
-import langchain
-from langchain_google_genai import ChatGoogleGenerativeAI
-from langchain_core.output_parsers import StrOutputParser
-from langchain_core.prompts import (
-    ChatPromptTemplate,
-    MessagesPlaceholder,
-)
-from langchain_core.runnables.base import RunnableSequence
-from langchain_core.output_parsers import JsonOutputParser, PydanticOutputParser
-from langchain_core.messages import HumanMessage, AIMessage
-from annoy import AnnoyIndex
-
-from retrieval import retrieve_docs, build_annoy_index
-from date_extraction import extract_dates, date_parser, Dates
-from intent_classifier import classify_intent, intent_parser, Intent
 from dotenv import load_dotenv
 
+from timing import StartupTimer
+from date_index import DateIndex
+from lexical_index import BM25Index
+from index_cache import DEFAULT_CACHE_DIR, cache_key
+from llm_cache import DEFAULT_LLM_CACHE_PATH, LLMResultCache
+
+# langchain, torch and annoy are imported when they are first needed, so that
+# `python bot.py --help` and the argument parsing do not pay for them.
+if TYPE_CHECKING:
+    from vector_store import VectorStore
+    from langchain_google_genai import ChatGoogleGenerativeAI
+    from langchain_core.output_parsers import JsonOutputParser, PydanticOutputParser
+    from langchain_core.runnables.base import RunnableSequence
+    from date_extraction import Dates
+    from intent_classifier import Intent
+    from pipeline import Pipeline
+    from prepared_chain import PreparedChain
+    from chat_history import ChatHistory
+
 load_dotenv()
 
 
@@ -55,168 +60,476 @@ CALENDAR_QA_PROMPT = """\
     Please ensure your responses utilize the calendar provided to accurately answer inquiries. Do not seek additional personal details unless the calendar data does not cover the user's question.
     """
 
+# ends an answer whose stream missed the answer stage's deadline
+TRUNCATED_MARKER = " [...answer cut off, please ask again]"
+
 
 async def get_intent(
     query: str,
     llm: ChatGoogleGenerativeAI,
-    parser: PydanticOutputParser | JsonOutputParser = intent_parser,
+    parser: PydanticOutputParser | JsonOutputParser | None = None,
+    use_local: bool = True,
+    cache: LLMResultCache | None = None,
+    prepared: PreparedChain | None = None,
 ) -> Intent:
     """Async function to classify intent."""
-    return classify_intent(query=query, llm=llm, parser=parser)
+    from intent_classifier import aclassify_intent, intent_parser
+
+    parser = parser or intent_parser
+    return await aclassify_intent(
+        query=query,
+        llm=llm,
+        parser=parser,
+        use_local=use_local,
+        cache=cache,
+        prepared=prepared,
+    )
 
 
 async def get_dates(
     query: str,
     llm: ChatGoogleGenerativeAI,
     formatted_date: str,
-    parser: PydanticOutputParser | JsonOutputParser = date_parser,
+    parser: PydanticOutputParser | JsonOutputParser | None = None,
+    use_rules: bool = True,
+    cache: LLMResultCache | None = None,
+    prepared: PreparedChain | None = None,
 ) -> Dates:
     """Async function to extract dates from query."""
-    return extract_dates(
-        query=query, llm=llm, formatted_date=formatted_date, parser=parser
+    from date_extraction import aextract_dates, date_parser
+
+    parser = parser or date_parser
+    return await aextract_dates(
+        query=query,
+        llm=llm,
+        formatted_date=formatted_date,
+        parser=parser,
+        use_rules=use_rules,
+        cache=cache,
+        prepared=prepared,
     )
 
 
-async def get_response(
-    chain: RunnableSequence, input: Dict, stream_response: bool = False
-) -> str:
-    """Async function collect Gemini response and prints each chunk as it arrives if stream_response (looks nicer)."""
-    if stream_response:
-        response = ""
-        print("Response: ", end="", flush=True)
-        async for chunk in chain.astream(input):
-            print(chunk, end="", flush=True)
-            response += chunk
-    else:
-        response = chain.invoke(input=input)
+async def understand_concurrently(
+    query: str,
+    llm: ChatGoogleGenerativeAI,
+    formatted_date: str,
+    use_local_intent: bool = True,
+    use_date_rules: bool = True,
+    fused: bool = False,
+    cache: LLMResultCache | None = None,
+    pipeline: Pipeline | None = None,
+) -> Tuple[Intent, Dates | None]:
+    """Classify intent, extract dates and embed the query at the same time.
+    Date extraction and the query embedding are speculative: if the intent is not
+    calendar_qa they are cancelled and dates is None. A turn then takes about as long as
+    its slowest stage instead of their sum.
+    """
+    from retrieval import get_embeddings
+    from query_understanding import aunderstand_query
+
+    speculative = []
+    # the local intent classifier embeds (and caches) the query itself
+    if not use_local_intent:
+        speculative.append(
+            asyncio.create_task(asyncio.to_thread(get_embeddings, query))
+        )
+    try:
+        if fused:
+            # one call for both, the result has .intent and .extracted_dates
+            intent = dates = await aunderstand_query(
+                query=query,
+                llm=llm,
+                formatted_date=formatted_date,
+                use_local_intent=use_local_intent,
+                use_date_rules=use_date_rules,
+                cache=cache,
+                prepared=pipeline and pipeline.fused,
+            )
+        else:
+            dates_task = asyncio.create_task(
+                get_dates(
+                    query=query,
+                    llm=llm,
+                    formatted_date=formatted_date,
+                    use_rules=use_date_rules,
+                    cache=cache,
+                    prepared=pipeline and pipeline.dates,
+                )
+            )
+            speculative.append(dates_task)
+            intent = await get_intent(
+                query=query,
+                llm=llm,
+                use_local=use_local_intent,
+                cache=cache,
+                prepared=pipeline and pipeline.intent,
+            )
+
+        if intent.intent != "calendar_qa":
+            return intent, None  # the speculative work is cancelled below
+        if not fused:
+            dates = await dates_task
+        await asyncio.gather(*speculative)
+        return intent, dates
+    finally:
+        for task in speculative:
+            task.cancel()
+        # retrieve the CancelledErrors so they are not reported as never retrieved
+        await asyncio.gather(*speculative, return_exceptions=True)
+
+
+async def emit(response: str, on_chunk: Callable[[str], Awaitable] | None = None):
+    """Print a whole response, or pass it to on_chunk as a single chunk."""
+    if on_chunk is None:
         print(f"Response: {response}")
-    return response
+    else:
+        await on_chunk(response)
 
 
-async def main(
+async def get_response(
+    chain: RunnableSequence,
+    input: Dict,
+    stream_response: bool = False,
+    on_chunk: Callable[[str], Awaitable] | None = None,
+) -> Tuple[str, bool]:
+    """Async function collect Gemini response and prints each chunk as it arrives if stream_response (looks nicer).
+    With on_chunk (e.g. a server session's send) the chunks are passed to it instead.
+    Returns the response as shown and whether it is complete, False if the stream was
+    cut off at the answer stage's deadline.
+    """
+    response = ""
+    try:
+        if on_chunk is not None:
+            async for chunk in chain.astream(input):
+                await on_chunk(chunk)
+                response += chunk
+        elif stream_response:
+            print("Response: ", end="", flush=True)
+            async for chunk in chain.astream(input):
+                print(chunk, end="", flush=True)
+                response += chunk
+        else:
+            response = await chain.ainvoke(input=input)
+            print(f"Response: {response}")
+    except TimeoutError as e:
+        # the LLM client gave up at the answer stage's deadline
+        if response:
+            # part of the answer is already out, mark where it stops
+            if on_chunk is not None:
+                await on_chunk(TRUNCATED_MARKER)
+            else:
+                print(TRUNCATED_MARKER)
+            print(e)
+            return response + TRUNCATED_MARKER, False
+        response = "Sorry, answering took too long, please ask again."
+        print(e)
+        await emit(response, on_chunk)
+    return response, True
+
+
+async def answer_question(
+    question: str,
+    chat_history: ChatHistory,
+    pipeline: Pipeline,
     calendar: List[Dict],
-    annoy_index: AnnoyIndex,
+    annoy_index: VectorStore,
     llm: ChatGoogleGenerativeAI,
+    date_index: DateIndex | None = None,
+    lexical_index: BM25Index | None = None,
+    lexical_mode: str = "fuse",
+    filter_by_dates: bool = False,
+    calendar_version: str | None = None,
+    use_date_rules: bool = True,
+    use_local_intent: bool = True,
+    fused: bool = False,
+    llm_cache: LLMResultCache | None = None,
+    context_tokens: int = 1000,
+    max_events: int = 0,
+    description_chars: int = 200,
     top_n: int = 3,
     verbose: int = 1,
     use_async=False,
     stream_response=False,
-):
-    """Main function to run the chatbot.
-    1. read user input query
-    2. classify intent
-    3. if intent is calendar_qa, extract dates, retrieve documents, and chat w/ Gemini.
+    on_chunk: Callable[[str], Awaitable] | None = None,
+) -> str:
+    """Answer one question and add the turn to chat_history.
+    1. classify intent
+    2. if intent is calendar_qa, extract dates, retrieve documents, and chat w/ Gemini.
+    The response is printed, or passed to on_chunk as it is generated.
     """
-    chat_history = []
+    from retrieval import (
+        query_batcher,
+        query_embedding_cache,
+        retrieval_cache,
+        retrieve_docs,
+    )
+    from date_extraction import extract_dates, date_parser, resolver_stats
+    from intent_classifier import classify_intent, intent_parser, intent_stats
+    from query_understanding import understand_query
+    from chat_history import count_message_tokens, estimate_tokens
+    from context_builder import build_context, json_context
 
-    while True:
-        question = input("Please enter your question or type 'exit' to quit: ")
-        if question.lower() == "exit":
-            print("Exiting the program.")
-            break
+    today = date.today()
+    formatted_date = today.strftime("%B %d, %Y")
 
-        today = date.today()
-        formatted_date = today.strftime("%B %d, %Y")
+    start_time = time.time()  # Start timing
+    dates = None
+    if use_async:
+        intent, dates = await understand_concurrently(
+            query=question,
+            llm=llm,
+            formatted_date=formatted_date,
+            use_local_intent=use_local_intent,
+            use_date_rules=use_date_rules,
+            fused=fused,
+            cache=llm_cache,
+            pipeline=pipeline,
+        )
+    elif fused:
+        # one call for both, the result has .intent and .extracted_dates
+        intent = dates = understand_query(
+            query=question,
+            llm=llm,
+            formatted_date=formatted_date,
+            use_local_intent=use_local_intent,
+            use_date_rules=use_date_rules,
+            cache=llm_cache,
+            prepared=pipeline.fused,
+        )
+    else:
+        intent = classify_intent(
+            query=question,
+            llm=llm,
+            parser=intent_parser,
+            use_local=use_local_intent,
+            cache=llm_cache,
+            prepared=pipeline.intent,
+        )
 
-        start_time = time.time()  # Start timing
-        if use_async:
-            intent = await get_intent(query=question, llm=llm, parser=intent_parser)
-        else:
-            intent = classify_intent(query=question, llm=llm, parser=intent_parser)
+    if verbose > 2:
+        print(
+            f"{'Intent and date' if use_async or fused else 'Intent'} retrieval time: "
+            f"{time.time() - start_time:.2f} seconds"
+        )
+        if use_local_intent:
+            print(
+                f"Intents classified locally: {intent_stats.local}, "
+                f"by the LLM: {intent_stats.fallback} "
+                f"({100 * intent_stats.hit_rate:.0f}% local)"
+            )
+        if llm_cache is not None:
+            print(f"LLM result cache: {llm_cache.hits} hits, {llm_cache.misses} misses")
+
+    if verbose > 0:
+        print(f"INTENT: {intent.intent}")
+
+    complete = True
+    if intent.intent == "ask_date":
+        response = f"Today's date is {formatted_date}."
+        await emit(response, on_chunk)
+    elif intent.intent == "out_of_scope":
+        response = (
+            "I can only answer questions about today's date or your personal calendar."
+        )
+        await emit(response, on_chunk)
+    # elif intent == "calendar_qa":
+    else:
+        if dates is None:
+            start_time = time.time()  # Start timing
+            dates = extract_dates(
+                query=question,
+                llm=llm,
+                formatted_date=formatted_date,
+                parser=date_parser,
+                use_rules=use_date_rules,
+                cache=llm_cache,
+                prepared=pipeline.dates,
+            )
+            if verbose > 2:
+                print(f"Date extraction time: {time.time() - start_time:.2f} seconds")
+        if verbose > 2 and use_date_rules:
+            print(
+                f"Dates resolved by rules: {resolver_stats.local}, "
+                f"by the LLM: {resolver_stats.fallback} "
+                f"({100 * resolver_stats.hit_rate:.0f}% local)"
+            )
 
+        start_time = time.time()  # Start timing
+        # TODO: check if this didnt break with pydantic
+        # in a worker thread, embedding the question would block other sessions
+        retriever_response = await asyncio.to_thread(
+            retrieve_docs,
+            query=question,
+            extracted_dates=dates.extracted_dates,
+            docs=calendar,
+            index=annoy_index,
+            # top_n bounds retrieval, the context keeps what fits the budget; with
+            # max_events more are retrieved to fill it from
+            top_n=max_events if context_tokens > 0 and max_events else top_n,
+            date_index=date_index,
+            lexical_index=lexical_index,
+            lexical_mode=lexical_mode,
+            filter_by_dates=filter_by_dates,
+            calendar_version=calendar_version,
+        )
         if verbose > 2:
-            print(f"Intent retrieval time: {time.time() - start_time:.2f} seconds")
+            print(f"Document retrieval time: {time.time() - start_time:.2f} seconds")
+            for name, cache in (
+                ("Query embedding", query_embedding_cache),
+                ("Retrieval result", retrieval_cache),
+            ):
+                stats = cache.stats()
+                print(
+                    f"{name} cache: {stats['hits']} hits, {stats['misses']} misses, "
+                    f"{stats['size']}/{stats['maxsize']} entries"
+                )
+            if query_batcher is not None:
+                print(query_batcher.stats.report())
 
-        if verbose > 0:
-            print(f"INTENT: {intent.intent}")
+        relevant_docs = retriever_response.get("relevant_docs", {})
 
-        if intent.intent == "ask_date":
-            response = f"Today's date is {formatted_date}."
-            print(f"Response: {response}")
-        elif intent.intent == "out_of_scope":
-            response = f"I can only answer questions about today's date or your personal calendar."
-            print(f"Response: {response}")
-        # elif intent == "calendar_qa":
-        else:
-            start_time = time.time()  # Start timing
+        if verbose > 0:
+            print(f"N DOCUMENTS RETRIEVED: {len(relevant_docs)}")
+            print(f"EXTRACTED DATES: {dates.extracted_dates}")
 
-            if use_async:
-                dates = await get_dates(
-                    query=question,
-                    llm=llm,
-                    formatted_date=formatted_date,
-                    parser=date_parser,
-                )
-            else:
-                dates = extract_dates(
-                    query=question,
-                    llm=llm,
-                    formatted_date=formatted_date,
-                    parser=date_parser,
+        if verbose > 1:
+            # print(f"DOCUMENTS RETRIEVED: {json.dumps(relevant_docs, indent=2)}")
+            print("DOCUMENTS RETRIEVED:")
+            for event in relevant_docs:
+                print(
+                    f"\t{event.get('date', 'NO DATE')}: {event.get('summary', 'NO SUMMARY')}, @ {event.get('location', 'NO LOCATION')}"
                 )
-            if verbose > 2:
-                print(f"Date extraction time: {time.time() - start_time:.2f} seconds")
+            print()
 
-            start_time = time.time()  # Start timing
-            # TODO: check if this didnt break with pydantic
-            retriever_response = retrieve_docs(
-                query=question,
-                extracted_dates=dates.extracted_dates,
-                docs=calendar,
-                index=annoy_index,
-                top_n=top_n,
+        if context_tokens > 0:
+            context, n_events = build_context(
+                relevant_docs, context_tokens, description_chars
             )
-            if verbose > 2:
+            if verbose > 0:
                 print(
-                    f"Document retrieval time: {time.time() - start_time:.2f} seconds"
+                    f"CALENDAR CONTEXT: {n_events}/{len(relevant_docs)} events, "
+                    f"{estimate_tokens(context)} tokens (estimated), "
+                    f"{estimate_tokens(json_context(relevant_docs[:n_events]))} "
+                    f"as indented JSON"
                 )
+        else:
+            context = json_context(relevant_docs)
+
+        answer_input = {
+            "date": formatted_date,
+            "calendar": context,
+            "chat_history": chat_history.messages(),
+            "question": question,
+        }
+        if verbose > 0:
+            prompt_tokens = count_message_tokens(
+                pipeline.answer.first.format_messages(**answer_input)
+            )
+            n_history_tokens = count_message_tokens(answer_input["chat_history"])
+            print(
+                f"PROMPT TOKENS (estimated): {prompt_tokens}, of which chat history: "
+                f"{n_history_tokens} ({len(chat_history.turns)} recent turns, "
+                f"{chat_history.n_summarized} summarized)"
+            )
 
-            relevant_docs = retriever_response.get("relevant_docs", {})
+        start_time = time.time()  # Start timing
+        response, complete = await get_response(
+            pipeline.answer,
+            input=answer_input,
+            stream_response=stream_response,
+            on_chunk=on_chunk,
+        )
+        if verbose > 2:
+            print(f"Response generation time: {time.time() - start_time:.2f} seconds")
+    if verbose > 2 and pipeline.client is not None:
+        print(pipeline.client.stats.report())
+
+    # a cut off answer is not kept, the next turn should not build on it
+    if complete:
+        # older turns are summarized in the background while the user types
+        chat_history.add_turn(question, response)
+    return response
 
-            if verbose > 0:
-                print(f"N DOCUMENTS RETRIEVED: {len(relevant_docs)}")
-                print(f"EXTRACTED DATES: {dates.extracted_dates}")
-
-            if verbose > 1:
-                # print(f"DOCUMENTS RETRIEVED: {json.dumps(relevant_docs, indent=2)}")
-                print(f"DOCUMENTS RETRIEVED:")
-                for event in relevant_docs:
-                    print(
-                        f"\t{event.get('date', 'NO DATE')}: {event.get('summary', 'NO SUMMARY')}, @ {event.get('location', 'NO LOCATION')}"
-                    )
-                print()
-
-            prompt = ChatPromptTemplate.from_messages(
-                [
-                    ("human", CALENDAR_QA_PROMPT),
-                    MessagesPlaceholder(variable_name="chat_history"),
-                    ("human", "{question}"),
-                ]
-            )
-            chain = prompt | llm | StrOutputParser()
 
-            start_time = time.time()  # Start timing
-            response = await get_response(
-                chain,
-                input={
-                    "date": formatted_date,
-                    "calendar": json.dumps(relevant_docs, indent=2),
-                    "chat_history": chat_history,
-                    "question": question,
-                },
-                stream_response=stream_response,
-            )
-            if verbose > 2:
-                print(
-                    f"Response generation time: {time.time() - start_time:.2f} seconds"
-                )
+async def main(
+    calendar: List[Dict],
+    annoy_index: VectorStore,
+    llm: ChatGoogleGenerativeAI,
+    date_index: DateIndex | None = None,
+    lexical_index: BM25Index | None = None,
+    lexical_mode: str = "fuse",
+    filter_by_dates: bool = False,
+    calendar_version: str | None = None,
+    use_date_rules: bool = True,
+    use_local_intent: bool = True,
+    fused: bool = False,
+    llm_cache: LLMResultCache | None = None,
+    pipeline: Pipeline | None = None,
+    history_tokens: int = 1000,
+    history_turns: int = 3,
+    context_tokens: int = 1000,
+    max_events: int = 0,
+    description_chars: int = 200,
+    top_n: int = 3,
+    verbose: int = 1,
+    use_async=False,
+    stream_response=False,
+):
+    """Main function to run the chatbot.
+    1. read user input query
+    2. answer it with answer_question
+    """
+    from pipeline import Pipeline
+    from chat_history import ChatHistory
+
+    # prompts and chains are built once, not on every turn
+    pipeline = pipeline or Pipeline(llm, CALENDAR_QA_PROMPT)
+
+    chat_history = ChatHistory(
+        pipeline.llm_for("summary"),
+        token_budget=history_tokens,
+        keep_turns=history_turns,
+        verbose=verbose > 0,
+    )
 
-        chat_history.extend(
-            [HumanMessage(content=question), AIMessage(content=response)]
+    while True:
+        # read in a worker thread so the event loop is never blocked
+        question = await asyncio.to_thread(
+            input, "Please enter your question or type 'exit' to quit: "
+        )
+        if question.lower() == "exit":
+            print("Exiting the program.")
+            await chat_history.aclose()
+            break
+        await answer_question(
+            question,
+            chat_history,
+            pipeline,
+            calendar=calendar,
+            annoy_index=annoy_index,
+            llm=llm,
+            date_index=date_index,
+            lexical_index=lexical_index,
+            lexical_mode=lexical_mode,
+            filter_by_dates=filter_by_dates,
+            calendar_version=calendar_version,
+            use_date_rules=use_date_rules,
+            use_local_intent=use_local_intent,
+            fused=fused,
+            llm_cache=llm_cache,
+            context_tokens=context_tokens,
+            max_events=max_events,
+            description_chars=description_chars,
+            top_n=top_n,
+            verbose=verbose,
+            use_async=use_async,
+            stream_response=stream_response,
         )
 
 
-if __name__ == "__main__":
+def build_arg_parser() -> argparse.ArgumentParser:
+    """Arguments of the bot, shared with server.py."""
     parser = argparse.ArgumentParser(
         description="Interact with a chat model to process calendar and date inquiries."
     )
@@ -232,7 +545,10 @@ if __name__ == "__main__":
         "-a",
         "--use_async",
         action="store_true",
-        help="Use async for intent classification and date extraction.",
+        help=(
+            "Classify intent, extract dates and embed the question concurrently, "
+            "cancelling the date and embedding work when the question is not about the calendar."
+        ),
     )
     parser.add_argument(
         "-s",
@@ -245,14 +561,206 @@ if __name__ == "__main__":
         "-n",
         "--top_n",
         default=5,
+        type=int,
         help="Top n documents to retrieve.",
     )
 
+    parser.add_argument(
+        "--context_tokens",
+        default=1000,
+        type=int,
+        help="Token budget of the calendar events in the answer prompt, rendered one compact line per event; the retrieved events that do not fit are left out. 0 sends the top_n events as JSON.",
+    )
+
+    parser.add_argument(
+        "--max_events",
+        default=0,
+        type=int,
+        help="With --context_tokens, retrieve this many events instead of top_n to fill the budget from, most relevant first. Default 0 retrieves top_n.",
+    )
+
+    parser.add_argument(
+        "--description_chars",
+        default=200,
+        type=int,
+        help="With --context_tokens, event descriptions are cut to this many characters.",
+    )
+
     parser.add_argument(
         "-f",
         "--fields",
         default=["location", "summary", "description"],
-        help="Text fields in calendar for annoy index.",
+        type=lambda fields: [field.strip() for field in fields.split(",")],
+        help="Comma separated text fields in calendar for annoy index.",
+    )
+
+    parser.add_argument(
+        "--cache_dir",
+        default=DEFAULT_CACHE_DIR,
+        type=str,
+        help=f"Directory for the cached index and embeddings. Default is '{DEFAULT_CACHE_DIR}'.",
+    )
+    parser.add_argument(
+        "--no_cache",
+        action="store_true",
+        help="Always rebuild the index instead of loading it from --cache_dir.",
+    )
+    parser.add_argument(
+        "-i",
+        "--incremental",
+        action="store_true",
+        help="Update the last index snapshot in --cache_dir with only the added, edited and deleted events.",
+    )
+    parser.add_argument(
+        "--compaction_threshold",
+        default=32,
+        type=int,
+        help="With --incremental, rebuild the main index in the background once this many events are pending in the delta.",
+    )
+
+    parser.add_argument(
+        "--vector_store",
+        choices=["auto", "numpy", "annoy", "hnsw"],
+        default="auto",
+        help=(
+            "Vector search backend: exact numpy search, Annoy or HNSW. "
+            "'auto' uses numpy for small calendars and benchmarks the backends on larger ones."
+        ),
+    )
+    parser.add_argument(
+        "--target_recall",
+        default=0.95,
+        type=float,
+        help="With --vector_store auto, the recall against exact search an approximate backend must reach.",
+    )
+
+    parser.add_argument(
+        "-l",
+        "--lexical",
+        choices=["off", "fuse", "fast"],
+        default="fuse",
+        help=(
+            "BM25 lexical retrieval: 'off' uses SBERT only, 'fuse' merges BM25 and SBERT rankings "
+            "with reciprocal-rank fusion, 'fast' also skips SBERT when one event clearly matches several query terms."
+        ),
+    )
+
+    parser.add_argument(
+        "--filter_by_dates",
+        action="store_true",
+        help=(
+            "Rank only the events in the extracted date window against the question, "
+            "keeping the top_n, instead of returning every event in the window."
+        ),
+    )
+
+    parser.add_argument(
+        "--no_date_rules",
+        action="store_true",
+        help="Always extract dates with the LLM instead of resolving common phrasings locally first.",
+    )
+
+    parser.add_argument(
+        "--fused",
+        action="store_true",
+        help="Classify intent and extract dates with a single LLM call instead of two.",
+    )
+
+    parser.add_argument(
+        "--llm_cache",
+        default=DEFAULT_LLM_CACHE_PATH,
+        type=str,
+        help=f"SQLite file caching the LLM's intent and date answers. Default is '{DEFAULT_LLM_CACHE_PATH}'.",
+    )
+
+    parser.add_argument(
+        "--no_llm_cache",
+        action="store_true",
+        help="Do not cache LLM intent and date answers.",
+    )
+
+    parser.add_argument(
+        "--fallback_model",
+        default="gemini-1.5-flash-latest",
+        type=str,
+        help="Faster Gemini model also asked once half of a call's deadline has passed, 'none' to disable. Default is 'gemini-1.5-flash-latest'.",
+    )
+
+    parser.add_argument(
+        "--deadlines",
+        default=None,
+        type=str,
+        help="Per-stage LLM deadlines in seconds, e.g. 'intent=5,answer=20'. Stages are intent, dates, fused, answer and summary.",
+    )
+
+    parser.add_argument(
+        "--no_hedge",
+        action="store_true",
+        help="Do not send a duplicate request when an LLM call is slower than usual.",
+    )
+
+    parser.add_argument(
+        "--hedge_quantile",
+        default=95,
+        type=float,
+        help="Latency percentile of a stage after which a hedged duplicate request is sent (default is 95).",
+    )
+
+    parser.add_argument(
+        "--history_tokens",
+        default=1000,
+        type=int,
+        help="Token budget of the chat history sent with each question; older turns are summarized. 0 sends the whole history verbatim.",
+    )
+
+    parser.add_argument(
+        "--history_turns",
+        default=3,
+        type=int,
+        help="Number of latest turns kept verbatim in the chat history before they are summarized.",
+    )
+
+    parser.add_argument(
+        "--no_local_intent",
+        action="store_true",
+        help="Always classify intent with the LLM instead of the local embedding classifier first.",
+    )
+
+    parser.add_argument(
+        "--query_cache_size",
+        default=256,
+        type=int,
+        help="Entries kept in the LRU caches of query embeddings and retrieval results, 0 disables them.",
+    )
+
+    parser.add_argument(
+        "-e",
+        "--embedder",
+        choices=["torch", "onnx", "onnx-int8"],
+        default="torch",
+        help="Embedding backend: PyTorch, ONNX Runtime, or ONNX Runtime with int8 dynamic quantization.",
+    )
+
+    parser.add_argument(
+        "--embed_batch_size",
+        default=0,
+        type=int,
+        help="Embed concurrent questions together, in batches of up to this many (0 embeds each on its own).",
+    )
+
+    parser.add_argument(
+        "--embed_batch_wait_ms",
+        default=5.0,
+        type=float,
+        help="With --embed_batch_size, milliseconds a question waits for others to join its batch.",
+    )
+
+    parser.add_argument(
+        "-b",
+        "--batch_size",
+        default=32,
+        type=int,
+        help="Number of calendar events embedded per forward pass when building the index.",
     )
 
     parser.add_argument(
@@ -269,33 +777,187 @@ if __name__ == "__main__":
             "3 -> Additionally, print processing time; "
         ),
     )
+    return parser
+
+
+def load_bot(args: argparse.Namespace, timer: StartupTimer | None = None) -> Dict:
+    """Load the calendar, indexes, caches and LLM client once, returns the keyword
+    arguments of main.
+    """
+    timer = timer or StartupTimer()
+    with timer.phase("import langchain and pipeline"):
+        from langchain_google_genai import ChatGoogleGenerativeAI
+
+        import retrieval
+        from retrieval import embed_docs
+        from vector_store import build_vector_store, select_backend
+        from index_cache import load_or_build_index
+        from incremental_index import IncrementalIndex
+        # loaded here so this phase times their import, their functions are
+        # imported where they are used
+        importlib.import_module("date_extraction")
+        importlib.import_module("intent_classifier")
+        from pipeline import Pipeline
+        from llm_client import LLMClient, create_on_llm_loop, parse_deadlines
+        from embedding_batcher import EmbeddingBatcher
+
+    if args.embedder != "torch":
+        from onnx_embedder import make_embedder
+
+        retrieval.set_embedder(make_embedder(retrieval.model_choice, args.embedder))
+    embedder = retrieval.embedder
+    if args.embed_batch_size > 0:
+        retrieval.set_query_batcher(
+            EmbeddingBatcher(
+                embedder,
+                max_batch_size=args.embed_batch_size,
+                max_wait=args.embed_batch_wait_ms / 1000,
+            )
+        )
 
-    args = parser.parse_args()
-    calendar = json.load(open(args.calendar_path))
-    for i, event in enumerate(calendar):
-        event["index_id"] = i
+    with timer.phase("load calendar"):
+        calendar = json.load(open(args.calendar_path))
+        for i, event in enumerate(calendar):
+            event["index_id"] = i
 
     print("Building index of calendar documents.")
     start_time = time.time()  # Start timing
-    annoy_index = build_annoy_index(calendar, args.fields)
+    with timer.phase("build or load vector index"):
+        if args.incremental:
+            annoy_index = IncrementalIndex.open(
+                calendar,
+                args.fields,
+                cache_dir=args.cache_dir,
+                model_name=embedder.cache_name,
+                compaction_threshold=args.compaction_threshold,
+                backend=args.vector_store,
+                target_recall=args.target_recall,
+                batch_size=args.batch_size,
+                verbose=args.verbose > 2,
+            )
+        elif args.no_cache:
+            embeddings = embed_docs(
+                calendar,
+                args.fields,
+                batch_size=args.batch_size,
+                verbose=args.verbose > 2,
+            )
+            if args.vector_store == "auto":
+                annoy_index = select_backend(
+                    embeddings,
+                    target_recall=args.target_recall,
+                    verbose=args.verbose > 2,
+                )
+            else:
+                annoy_index = build_vector_store(embeddings, args.vector_store)
+        else:
+            annoy_index, _ = load_or_build_index(
+                calendar,
+                args.fields,
+                cache_dir=args.cache_dir,
+                model_name=embedder.cache_name,
+                backend=args.vector_store,
+                target_recall=args.target_recall,
+                batch_size=args.batch_size,
+                verbose=args.verbose > 2,
+            )
 
     if args.verbose > 2:
         print(f"Annoy index building time: {time.time() - start_time:.2f} seconds")
 
-    llm = ChatGoogleGenerativeAI(
-        api_key=os.getenv("GOOGLE_API_KEY"), model="gemini-1.5-pro-latest"
+    # changes whenever the calendar, indexed fields, model or vector store do, so
+    # cached retrieval results never outlive the index they were computed on
+    calendar_version = (
+        f"{cache_key(calendar, args.fields, embedder.cache_name)}-{args.vector_store}"
+        f"-{'incremental' if args.incremental else 'full'}"
     )
-    print("Using Gemini API.")
+    retrieval.query_embedding_cache.resize(args.query_cache_size)
+    retrieval.retrieval_cache.resize(args.query_cache_size)
 
-    nest_asyncio.apply()
-    asyncio.run(
-        main(
-            calendar=calendar,
-            annoy_index=annoy_index,
-            llm=llm,
-            top_n=args.top_n,
-            verbose=args.verbose,
-            use_async=args.use_async,
-            stream_response=args.stream,
+    with timer.phase("build date index"):
+        date_index = DateIndex(calendar, verbose=args.verbose > 0)
+
+    # built next to the vector index, BM25 needs no model and is cheap to rebuild
+    with timer.phase("build BM25 index"):
+        lexical_index = (
+            BM25Index(calendar, args.fields) if args.lexical != "off" else None
+        )
+
+    with timer.phase("open LLM result cache"):
+        llm_cache = None
+        if not args.no_llm_cache:
+            llm_cache = LLMResultCache(args.llm_cache)
+            llm_cache.evict()
+
+    with timer.phase("create LLM client"):
+        # built on the loop the client sends requests on, so they get an async
+        # client and cancelling a hedge or a late request stops its HTTP call
+        llm = create_on_llm_loop(
+            ChatGoogleGenerativeAI,
+            api_key=os.getenv("GOOGLE_API_KEY"),
+            model="gemini-1.5-pro-latest",
+        )
+        fallback_llm = None
+        if args.fallback_model != "none":
+            fallback_llm = create_on_llm_loop(
+                ChatGoogleGenerativeAI,
+                api_key=os.getenv("GOOGLE_API_KEY"),
+                model=args.fallback_model,
+            )
+        llm_client = LLMClient(
+            llm,
+            fallback=fallback_llm,
+            deadlines=parse_deadlines(args.deadlines) if args.deadlines else None,
+            hedge=not args.no_hedge,
+            hedge_quantile=args.hedge_quantile,
         )
+    print("Using Gemini API.")
+
+    with timer.phase("build prompts and chains"):
+        pipeline = Pipeline(llm, CALENDAR_QA_PROMPT, client=llm_client)
+
+    return dict(
+        calendar=calendar,
+        annoy_index=annoy_index,
+        llm=llm,
+        date_index=date_index,
+        lexical_index=lexical_index,
+        lexical_mode=args.lexical,
+        filter_by_dates=args.filter_by_dates,
+        calendar_version=calendar_version,
+        use_date_rules=not args.no_date_rules,
+        use_local_intent=not args.no_local_intent,
+        fused=args.fused,
+        llm_cache=llm_cache,
+        pipeline=pipeline,
+        history_tokens=args.history_tokens,
+        history_turns=args.history_turns,
+        context_tokens=args.context_tokens,
+        max_events=args.max_events,
+        description_chars=args.description_chars,
+        top_n=args.top_n,
+        verbose=args.verbose,
+        use_async=args.use_async,
+        stream_response=args.stream,
     )
+
+
+if __name__ == "__main__":
+    parser = build_arg_parser()
+    timer = StartupTimer()
+    with timer.phase("parse arguments"):
+        args = parser.parse_args()
+
+    settings = load_bot(args, timer)
+
+    if args.verbose > 2:
+        print(timer.report())
+
+    # with a cached index the model is only needed for query embeddings, load it
+    # while the user types the first question
+    import retrieval
+
+    if not retrieval.embedder.loaded:
+        retrieval.embedder.load_in_background()
+
+    asyncio.run(main(**settings))
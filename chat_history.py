@@ -0,0 +1,138 @@
+"""Chat history kept under a token budget.
+
+bot.main used to send every earlier question and answer with each calendar question, so
+the prompt, its latency and its cost grew with the session. ChatHistory keeps the last
+keep_turns turns verbatim and folds older ones into a running summary. The summary is
+written by the LLM in a background task started after the answer has been printed, so
+it runs while the user types the next question; until it is done the turns being
+folded are still sent verbatim. messages() never returns more than token_budget
+(estimated) tokens, dropping the oldest verbatim turns first.
+
+Tokens are estimated from the text length (about 4 characters per token for Gemini),
+which avoids a count_tokens API call per message.
+"""
+
+import asyncio
+import math
+from typing import List, Tuple
+
+from langchain_core.messages import AIMessage, BaseMessage, HumanMessage
+from langchain_core.output_parsers import StrOutputParser
+from langchain_core.prompts import PromptTemplate
+
+CHARS_PER_TOKEN = 4
+
+SUMMARY_PROMPT = """\
+Summarize the conversation between a user and their calendar assistant so that the
+assistant can answer follow-up questions. Keep the events, dates, times, places and
+names mentioned and what the user wanted to know; drop greetings and repetition.
+Answer with the summary only, in at most {max_words} words.
+
+Summary so far:
+{summary}
+
+New turns:
+{turns}
+"""
+
+
+def estimate_tokens(text: str) -> int:
+    return math.ceil(len(text) / CHARS_PER_TOKEN)
+
+
+def count_message_tokens(messages: List[BaseMessage]) -> int:
+    return sum(estimate_tokens(message.content) for message in messages)
+
+
+def format_turns(turns: List[Tuple[HumanMessage, AIMessage]]) -> str:
+    return "\n".join(
+        f"User: {question.content}\nAssistant: {answer.content}"
+        for question, answer in turns
+    )
+
+
+class ChatHistory:
+    """Earlier turns of the conversation, to pass as the answer prompt's chat_history.
+    A token_budget of 0 keeps every turn verbatim, like a plain list.
+    """
+
+    def __init__(
+        self,
+        llm,
+        token_budget: int = 1000,
+        keep_turns: int = 3,
+        verbose: bool = False,
+    ):
+        self.token_budget = token_budget
+        self.keep_turns = keep_turns
+        self.verbose = verbose
+        self.summary = ""
+        self.n_summarized = 0
+        self.turns: List[Tuple[HumanMessage, AIMessage]] = []
+        self._chain = (
+            PromptTemplate.from_template(SUMMARY_PROMPT) | llm | StrOutputParser()
+        )
+        self._task: asyncio.Task | None = None
+
+    def add_turn(self, question: str, answer: str):
+        """Record a turn and, when older turns are due, start folding them into the
+        summary in the background. Must be called from the running event loop.
+        """
+        self.turns.append((HumanMessage(content=question), AIMessage(content=answer)))
+        n_fold = len(self.turns) - self.keep_turns
+        if self.token_budget <= 0 or n_fold <= 0 or self.summarizing:
+            return
+        self._task = asyncio.create_task(self._fold(n_fold))
+
+    @property
+    def summarizing(self) -> bool:
+        return self._task is not None and not self._task.done()
+
+    async def _fold(self, n_fold: int):
+        turns = self.turns[:n_fold]
+        try:
+            summary = await self._chain.ainvoke(
+                {
+                    "summary": self.summary or "(none)",
+                    "turns": format_turns(turns),
+                    # leave room for the verbatim turns
+                    "max_words": max(self.token_budget // 2, 50),
+                }
+            )
+        except Exception as e:
+            # the turns stay verbatim and are folded with the next ones
+            if self.verbose:
+                print(f"Chat history summarization failed: {e}")
+            return
+        self.summary = summary.strip()
+        self.n_summarized += n_fold
+        # only add_turn appends meanwhile, so the folded turns are still first
+        del self.turns[:n_fold]
+
+    def summary_message(self) -> List[BaseMessage]:
+        if not self.summary:
+            return []
+        return [
+            HumanMessage(content=f"Summary of our earlier conversation: {self.summary}")
+        ]
+
+    def messages(self) -> List[BaseMessage]:
+        """The summary and as many of the latest turns as fit in the token budget."""
+        turns = [message for turn in self.turns for message in turn]
+        if self.token_budget <= 0:
+            return turns
+        messages = self.summary_message()
+        budget = self.token_budget - count_message_tokens(messages)
+        n_kept = 0
+        for question, answer in reversed(self.turns):
+            budget -= count_message_tokens([question, answer])
+            if budget < 0:
+                break
+            n_kept += 1
+        return messages + turns[len(turns) - 2 * n_kept :]
+
+    async def aclose(self):
+        """Cancel a running summarization, e.g. before exiting."""
+        if self.summarizing:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
@@ -0,0 +1,65 @@
+"""Compact calendar context for the answer prompt.
+
+bot.main used to put the retrieved events in the prompt as indented JSON, with the
+retrieval scores, index ids and timestamps the LLM has no use for and descriptions of
+any length. build_context renders each event as one line of its user-facing fields,
+    Sunday May 12, 2024, 10:30AM-12:30PM | Team meeting | @ Room 101 | Weekly sync...
+cuts long descriptions, and adds events in retrieval (relevance) order until the token
+budget is spent, so the prompt holds as many events as fit rather than a fixed top_n.
+"""
+
+import json
+import re
+from typing import Dict, List, Tuple
+
+from chat_history import estimate_tokens
+
+CONTEXT_FIELDS = ["date", "summary", "location", "description"]
+
+
+def shorten(text: str, max_chars: int) -> str:
+    """Collapse whitespace and cut text to max_chars, marking the cut with '...'."""
+    text = " ".join(str(text).split())
+    if max_chars and len(text) > max_chars:
+        text = text[: max_chars - 3].rstrip() + "..."
+    return text
+
+
+def format_event(doc: Dict, max_description_chars: int = 200) -> str:
+    parts = []
+    for field in CONTEXT_FIELDS:
+        value = doc.get(field)
+        if not value:
+            continue
+        if field == "description":
+            # descriptions from Google Calendar may hold HTML
+            value = shorten(re.sub(r"<[^>]+>", " ", value), max_description_chars)
+        elif field == "location":
+            value = f"@ {shorten(value, max_description_chars)}"
+        else:
+            value = shorten(value, max_description_chars)
+        parts.append(value)
+    return " | ".join(parts)
+
+
+def build_context(
+    docs: List[Dict], token_budget: int = 1000, max_description_chars: int = 200
+) -> Tuple[str, int]:
+    """Return the calendar context for docs, in order, and how many of them it holds.
+    The first event is always included; with a token_budget of 0 all of them are.
+    """
+    lines = []
+    n_tokens = 0
+    for doc in docs:
+        line = format_event(doc, max_description_chars)
+        line_tokens = estimate_tokens(line) + 1
+        if token_budget > 0 and lines and n_tokens + line_tokens > token_budget:
+            break
+        lines.append(line)
+        n_tokens += line_tokens
+    return "\n".join(lines), len(lines)
+
+
+def json_context(docs: List[Dict]) -> str:
+    """The calendar context as the bot used to send it, to compare against."""
+    return json.dumps(docs, indent=2)
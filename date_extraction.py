@@ -2,7 +2,6 @@ import asyncio
 import nest_asyncio
 import json
 import os
-import re
 from datetime import date
 
 from dotenv import load_dotenv
@@ -11,10 +10,13 @@ import langchain
 from langchain_google_genai import ChatGoogleGenerativeAI
 
 from langchain_core.output_parsers import JsonOutputParser, PydanticOutputParser
-from langchain_core.prompts import PromptTemplate
 from langchain_core.pydantic_v1 import BaseModel, Field
 from typing import List
 
+from date_rules import ResolverStats, resolve_dates
+from llm_cache import LLMResultCache, acached_invoke, cached_invoke
+from prepared_chain import PreparedChain
+
 load_dotenv()
 
 DATE_EXTRACTION_PROMPT = """
@@ -74,6 +76,30 @@ class Dates(BaseModel):
 # date_parser = JsonOutputParser(pydantic_object=Dates)
 date_parser = PydanticOutputParser(pydantic_object=Dates)
 
+# how many queries date_rules resolved without the LLM
+resolver_stats = ResolverStats()
+
+
+def dates_chain(
+    llm, parser: JsonOutputParser | PydanticOutputParser = date_parser
+) -> PreparedChain:
+    """The date extraction chain, to build once and pass to extract_dates."""
+    return PreparedChain(DATE_EXTRACTION_PROMPT, ["date", "query"], parser, llm)
+
+
+def extract_dates_locally(query, formatted_date, verbose: bool = False) -> Dates | None:
+    """The dates date_rules resolves for query, None if it needs the LLM."""
+    extracted_dates = resolve_dates(query, formatted_date)
+    resolver_stats.record(extracted_dates is not None)
+    if extracted_dates is None:
+        return None
+    response = Dates(extracted_dates=extracted_dates)
+    if verbose:
+        print(
+            f"Query: {query} \n  Current Date: {formatted_date} \n    -> Extracted Dates (rules): {response.extracted_dates}"
+        )
+    return response
+
 
 def extract_dates(
     query,
@@ -81,30 +107,38 @@ def extract_dates(
     formatted_date,
     parser: JsonOutputParser | PydanticOutputParser = date_parser,
     verbose: str = False,
+    use_rules: bool = True,
+    cache: LLMResultCache | None = None,
+    prepared: PreparedChain | None = None,
 ):
-
+    """Extract the dates query refers to.
+    With use_rules the query is first resolved locally by date_rules, the LLM is only
+    called for phrasings its grammar cannot parse. With a cache, LLM answers are looked
+    up in and saved to it, keyed by query and today's date among others. prepared is
+    the chain from dates_chain, built here if not given.
+    If the LLM fails even after the retry, no dates are returned, so retrieval still
+    runs on the query alone.
+    """
+    if use_rules:
+        response = extract_dates_locally(query, formatted_date, verbose)
+        if response is not None:
+            return response
+    prepared = prepared or dates_chain(llm, parser)
     try:
-        prompt = PromptTemplate(
-            template=DATE_EXTRACTION_PROMPT,
-            input_variables=["date", "query"],
-            partial_variables={"format_instructions": parser.get_format_instructions()},
+        response = cached_invoke(
+            cache,
+            "dates",
+            query,
+            formatted_date,
+            prepared,
+            {"date": formatted_date, "query": query},
         )
-
-        chain = prompt | llm | parser
-
-        response = chain.invoke({"date": formatted_date, "query": query})
+    except Exception as e:
+        print(f"Date extraction failed, continuing without dates: {e}")
+        return Dates(extracted_dates=[])
     # response["query"] = query
     # response["today"] = formatted_date
-    except:
-
-        # if we don't get a response, try again with this
-        prompt = PromptTemplate(
-            template=PromptTemplate,
-            input_variables=["date", "query"],
-        ).partial(
-            format_instructions=parser.get_format_instructions(),
-            pattern=re.compile(r"\`\`\`\n\`\`\`"),
-        )
+
     if verbose:
         # print(
         #     f"Current Date: {formatted_date} \n -> Extracted Dates: {response.get('extracted_dates', [])}"
@@ -116,6 +150,44 @@ def extract_dates(
     return response
 
 
+async def aextract_dates(
+    query,
+    llm,
+    formatted_date,
+    parser: JsonOutputParser | PydanticOutputParser = date_parser,
+    verbose: bool = False,
+    use_rules: bool = True,
+    cache: LLMResultCache | None = None,
+    prepared: PreparedChain | None = None,
+) -> Dates:
+    """extract_dates calling the LLM with ainvoke, so it can run concurrently with
+    the other stages of a turn.
+    """
+    if use_rules:
+        response = extract_dates_locally(query, formatted_date, verbose)
+        if response is not None:
+            return response
+    prepared = prepared or dates_chain(llm, parser)
+    try:
+        response = await acached_invoke(
+            cache,
+            "dates",
+            query,
+            formatted_date,
+            prepared,
+            {"date": formatted_date, "query": query},
+        )
+    except Exception as e:
+        print(f"Date extraction failed, continuing without dates: {e}")
+        return Dates(extracted_dates=[])
+
+    if verbose:
+        print(
+            f"Query: {query} \n  Current Date: {formatted_date} \n    -> Extracted Dates: {response.extracted_dates}"
+        )
+    return response
+
+
 if __name__ == "__main__":
     verbose = True
 
@@ -165,3 +237,8 @@ if __name__ == "__main__":
 
         with open(f"query_data/gemini_date_retrieval_{idx}.json", "w") as f:
             json.dump(query_data, f, indent=2)
+
+    print(
+        f"Resolved {resolver_stats.local} of {resolver_stats.local + resolver_stats.fallback} "
+        f"queries without the LLM ({100 * resolver_stats.hit_rate:.0f}%)"
+    )
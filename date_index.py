@@ -0,0 +1,189 @@
+"""Interval index from calendar time ranges to events.
+
+Event dates are stored as display strings like 'Sunday May 12, 2024, 10:30AM-12:30PM'
+or 'Saturday June 01, 2024, 10:00PM - Sunday June 02, 2024, 10:00AM', so matching them
+against the extracted dates of a query means parsing every event. The DateIndex parses
+each event once when the calendar is loaded into a numeric [start, end) interval and
+stores the intervals in a static interval tree. A lookup merges the extracted dates into
+day ranges and returns every event overlapping them in O(log N + k), so multi-day and
+overnight events match on every day they span.
+
+Calendars written by download_calendar also carry numeric start_ts/end_ts/utc_offset
+columns, which are used directly instead of parsing the string.
+
+Times are wall-clock seconds: the event's local time measured from 1970-01-01 as if it
+were UTC, so a calendar day is always an 86400 second range.
+"""
+
+from datetime import date, datetime, timedelta
+from typing import Dict, Iterable, List, Tuple
+
+EPOCH = datetime(1970, 1, 1)
+DAY_SECONDS = 86400
+DOC_DATE_FORMAT = "%A %B %d, %Y, %I:%M%p"
+
+
+def wall_seconds(dt: datetime) -> float:
+    return (dt - EPOCH).total_seconds()
+
+
+def day_range(day: date) -> Tuple[float, float]:
+    start = wall_seconds(datetime(day.year, day.month, day.day))
+    return start, start + DAY_SECONDS
+
+
+def parse_doc_datetime(part: str, end: bool = False) -> datetime:
+    """Parse one side of a multi-day event date, a side without a time is a whole day."""
+    part = part.strip()
+    if part.count(",") < 2:
+        day = datetime.strptime(part, "%A %B %d, %Y")
+        return day + timedelta(days=1) if end else day
+    return datetime.strptime(part, DOC_DATE_FORMAT)
+
+
+def parse_doc_interval(doc_date: str) -> Tuple[datetime, datetime] | None:
+    """Parse an event date string into (start, end), None if it is malformed.
+    A date without times covers the whole day.
+    """
+    try:
+        if " - " in doc_date:
+            start_part, end_part = doc_date.split(" - ", 1)
+            start = parse_doc_datetime(start_part)
+            return start, parse_doc_datetime(end_part, end=True)
+        parts = doc_date.split(",")
+        day_part = f"{parts[0]},{parts[1]}"
+        if len(parts) < 3:
+            start = datetime.strptime(day_part, "%A %B %d, %Y")
+            return start, start + timedelta(days=1)
+        times = parts[2].strip().split("-")
+        start = datetime.strptime(f"{day_part}, {times[0]}", DOC_DATE_FORMAT)
+        end = datetime.strptime(f"{day_part}, {times[-1]}", DOC_DATE_FORMAT)
+        if end < start:
+            end += timedelta(days=1)
+        return start, end
+    except (ValueError, IndexError):
+        return None
+
+
+def doc_interval(doc: Dict) -> Tuple[float, float] | None:
+    """Wall-clock [start, end) of an event, None if it has no usable date.
+    Uses the numeric columns written by download_calendar when present, otherwise
+    parses the date string.
+    """
+    if "start_ts" in doc and "end_ts" in doc:
+        offset = doc.get("utc_offset", 0)
+        end_offset = doc.get("end_utc_offset", offset)
+        return doc["start_ts"] + offset, doc["end_ts"] + end_offset
+    interval = parse_doc_interval(doc.get("date", ""))
+    if interval is None:
+        return None
+    return wall_seconds(interval[0]), wall_seconds(interval[1])
+
+
+def parse_extracted_date(extracted_date: str) -> date | None:
+    """Parse a 'Month DD, YYYY' date from date extraction, None if it is malformed."""
+    try:
+        return datetime.strptime(extracted_date.strip(), "%B %d, %Y").date()
+    except ValueError:
+        return None
+
+
+def merge_days(days: Iterable[date]) -> List[Tuple[float, float]]:
+    """Merge days into sorted, non-overlapping [start, end) ranges of consecutive days."""
+    ranges = []
+    for day in sorted(set(days)):
+        start, end = day_range(day)
+        if ranges and ranges[-1][1] == start:
+            ranges[-1] = (ranges[-1][0], end)
+        else:
+            ranges.append((start, end))
+    return ranges
+
+
+class IntervalTree:
+    """Static centered interval tree over half-open [start, end) intervals.
+    Each node keeps the intervals containing its center sorted by start and by end,
+    intervals entirely left or right of the center go to its children.
+    """
+
+    def __init__(self, intervals: List[Tuple[float, float, int]]):
+        self.center = None
+        self.by_start = []
+        self.by_end = []
+        self.left = None
+        self.right = None
+        if not intervals:
+            return
+        starts = sorted(start for start, _, _ in intervals)
+        self.center = center = starts[len(starts) // 2]
+        here, left, right = [], [], []
+        for interval in intervals:
+            start, end, _ = interval
+            if end <= center:
+                left.append(interval)
+            elif start > center:
+                right.append(interval)
+            else:
+                here.append(interval)
+        self.by_start = sorted(here, key=lambda interval: interval[0])
+        self.by_end = sorted(here, key=lambda interval: interval[1], reverse=True)
+        self.left = IntervalTree(left) if left else None
+        self.right = IntervalTree(right) if right else None
+
+    def overlap(self, lo: float, hi: float) -> List[int]:
+        """Return the ids of the intervals overlapping [lo, hi)."""
+        found = []
+        nodes = [self]
+        while nodes:
+            node = nodes.pop()
+            if node.center is None:
+                continue
+            if hi <= node.center:
+                # every interval here ends after the center, check the starts
+                for start, _, doc_id in node.by_start:
+                    if start >= hi:
+                        break
+                    found.append(doc_id)
+                if node.left:
+                    nodes.append(node.left)
+            elif lo > node.center:
+                # every interval here starts at or before the center, check the ends
+                for _, end, doc_id in node.by_end:
+                    if end <= lo:
+                        break
+                    found.append(doc_id)
+                if node.right:
+                    nodes.append(node.right)
+            else:
+                found.extend(doc_id for _, _, doc_id in node.by_start)
+                nodes.extend(child for child in (node.left, node.right) if child)
+        return found
+
+
+class DateIndex:
+    def __init__(self, docs: List[Dict], verbose: bool = False):
+        intervals = []
+        self.unparsed: List[int] = []
+        for doc in docs:
+            interval = doc_interval(doc)
+            if interval is None:
+                self.unparsed.append(doc["index_id"])
+                continue
+            start, end = interval
+            # zero length events still belong to the day they happen on
+            intervals.append((start, max(end, start + 1), doc["index_id"]))
+        self.tree = IntervalTree(intervals)
+        if verbose and self.unparsed:
+            print(f"Could not parse the date of {len(self.unparsed)} events.")
+
+    def lookup_range(self, start: datetime, end: datetime) -> List[int]:
+        """Return the index_ids of events overlapping [start, end), in calendar order."""
+        return sorted(set(self.tree.overlap(wall_seconds(start), wall_seconds(end))))
+
+    def lookup(self, extracted_dates: Iterable[str]) -> List[int]:
+        """Return the index_ids of events on any of extracted_dates, in calendar order."""
+        days = [parse_extracted_date(d) for d in extracted_dates]
+        doc_ids = set()
+        for lo, hi in merge_days(day for day in days if day is not None):
+            doc_ids.update(self.tree.overlap(lo, hi))
+        return sorted(doc_ids)
@@ -0,0 +1,249 @@
+"""Rule-based resolver for the date phrases calendar questions use.
+
+Most questions name their dates with a handful of phrasings: 'today', 'tomorrow',
+'this weekend', 'next Monday', 'last week', 'every Tuesday', 'June 25th'. resolve_dates
+turns those into the same 'Month D, YYYY' strings the LLM extractor returns, following
+the rules of the examples in date_extraction.DATE_EXTRACTION_PROMPT:
+    - 'next Tuesday' is the first Tuesday after today, a bare or 'this' weekday the
+      first one from today on, 'last Thursday' the latest one before today,
+    - weeks run Monday to Sunday and 'this week' is the whole current week,
+    - a recurring weekday ('every Tuesday') gives its four upcoming dates.
+It returns None when the query contains a date word its grammar cannot place (e.g.
+'the first Friday of July'), and the caller falls back to the LLM; a query without any
+date words resolves to no dates.
+"""
+
+import calendar
+import re
+import threading
+from datetime import date, datetime, timedelta
+from typing import Dict, List
+
+MONTHS = {
+    name: i
+    for i, names in enumerate(
+        [
+            ("january", "jan"),
+            ("february", "feb"),
+            ("march", "mar"),
+            ("april", "apr"),
+            ("may",),
+            ("june", "jun"),
+            ("july", "jul"),
+            ("august", "aug"),
+            ("september", "sep", "sept"),
+            ("october", "oct"),
+            ("november", "nov"),
+            ("december", "dec"),
+        ],
+        start=1,
+    )
+    for name in names
+}
+WEEKDAYS = {
+    name: i
+    for i, name in enumerate(
+        ["monday", "tuesday", "wednesday", "thursday", "friday", "saturday", "sunday"]
+    )
+}
+NUMBER_WORDS = {
+    word: i
+    for i, word in enumerate(
+        ["one", "two", "three", "four", "five", "six", "seven", "eight", "nine", "ten"],
+        start=1,
+    )
+}
+# a query whose unparsed remainder still contains one of these needs the LLM
+# ("may" is left out, it is more often the verb)
+DATE_WORDS = (
+    set(MONTHS) - {"may"}
+    | set(WEEKDAYS)
+    | {f"{name}s" for name in WEEKDAYS}
+    | {"today", "tonight", "tomorrow", "yesterday", "weekend", "weekends"}
+    | {"day", "days", "week", "weeks", "month", "months", "year", "years"}
+    | {"fortnight", "ago", "weekday", "weekdays", "morning", "afternoon", "evening"}
+    # modifiers that shift or bound a matched date ("the weekend after next")
+    | {"after", "before", "following", "until", "till", "since", "between"}
+)
+TODAY_FORMATS = ["%A, %B %d, %Y", "%B %d, %Y"]
+N_RECURRING = 4
+
+_MONTH = "|".join(sorted(MONTHS, key=len, reverse=True))
+_WEEKDAY = "|".join(WEEKDAYS)
+_NUMBER = r"\d+|" + "|".join(NUMBER_WORDS)
+_RELATIVE = r"this coming|this|next|last|past|previous|coming"
+
+PATTERNS = [
+    ("day_after_tomorrow", r"(?:the )?day after tomorrow"),
+    ("day_before_yesterday", r"(?:the )?day before yesterday"),
+    ("today", r"today|tonight|this (?:morning|afternoon|evening)"),
+    ("tomorrow", r"tomorrow"),
+    ("yesterday", r"yesterday"),
+    ("recurring", rf"every (?P<every>{_WEEKDAY})|(?:on )?(?P<plural>{_WEEKDAY})s"),
+    ("weekday", rf"(?:(?P<weekday_rel>{_RELATIVE}) )?(?P<day_name>{_WEEKDAY})"),
+    ("weekend", rf"(?:(?P<weekend_rel>{_RELATIVE}|the) )?weekend"),
+    ("period", rf"(?P<period_rel>{_RELATIVE}) (?P<unit>week|month)"),
+    (
+        "month_day",
+        rf"(?P<md_month>{_MONTH})\.? (?P<md_day>\d{{1,2}})(?:st|nd|rd|th)?"
+        rf"(?:,? (?P<md_year>\d{{4}}))?",
+    ),
+    (
+        "day_month",
+        rf"(?:the )?(?P<dm_day>\d{{1,2}})(?:st|nd|rd|th)? (?:of )?(?P<dm_month>{_MONTH})"
+        rf"(?:,? (?P<dm_year>\d{{4}}))?",
+    ),
+    ("in_n", rf"in (?P<in_count>{_NUMBER}) (?P<in_unit>day|week)s?"),
+    ("n_ago", rf"(?P<ago_count>{_NUMBER}) (?P<ago_unit>day|week)s? ago"),
+]
+DATE_PATTERN = re.compile(
+    "|".join(rf"\b(?P<{name}>{pattern})\b" for name, pattern in PATTERNS)
+)
+
+
+def parse_today(formatted_date: str) -> date:
+    """Parse today's date as bot.py and date_extraction format it."""
+    for fmt in TODAY_FORMATS:
+        try:
+            return datetime.strptime(formatted_date, fmt).date()
+        except ValueError:
+            continue
+    raise ValueError(f"Unrecognised date: {formatted_date}")
+
+
+def format_date(day: date) -> str:
+    return f"{day:%B} {day.day}, {day.year}"
+
+
+def day_span(start: date, n_days: int) -> List[date]:
+    return [start + timedelta(days=i) for i in range(n_days)]
+
+
+def next_weekday(today: date, weekday: int, strictly_after: bool = False) -> date:
+    days_ahead = (weekday - today.weekday()) % 7
+    if days_ahead == 0 and strictly_after:
+        days_ahead = 7
+    return today + timedelta(days=days_ahead)
+
+
+def this_weekend(today: date) -> date:
+    """Saturday of the weekend containing today, or of the coming one."""
+    if today.weekday() == 6:
+        return today - timedelta(days=1)
+    return next_weekday(today, 5)
+
+
+def parse_number(text: str) -> int:
+    return NUMBER_WORDS[text] if text in NUMBER_WORDS else int(text)
+
+
+def resolve_match(match: re.Match, today: date) -> List[date]:
+    kind, groups = match.lastgroup, match.groupdict()
+    if kind == "today":
+        return [today]
+    if kind == "tomorrow":
+        return [today + timedelta(days=1)]
+    if kind == "yesterday":
+        return [today - timedelta(days=1)]
+    if kind == "day_after_tomorrow":
+        return [today + timedelta(days=2)]
+    if kind == "day_before_yesterday":
+        return [today - timedelta(days=2)]
+    if kind == "recurring":
+        first = next_weekday(today, WEEKDAYS[groups["every"] or groups["plural"]])
+        return [first + timedelta(weeks=i) for i in range(N_RECURRING)]
+    if kind == "weekday":
+        weekday, relation = WEEKDAYS[groups["day_name"]], groups["weekday_rel"]
+        if relation in ("last", "past", "previous"):
+            return [today - timedelta(days=(today.weekday() - weekday - 1) % 7 + 1)]
+        return [next_weekday(today, weekday, strictly_after=relation == "next")]
+    if kind == "weekend":
+        saturday = this_weekend(today)
+        relation = groups["weekend_rel"]
+        if relation == "next":
+            saturday += timedelta(weeks=1)
+        elif relation in ("last", "past", "previous"):
+            saturday -= timedelta(weeks=1)
+        return day_span(saturday, 2)
+    if kind == "period":
+        shift = {"next": 1, "last": -1, "past": -1, "previous": -1}.get(
+            groups["period_rel"], 0
+        )
+        if groups["unit"] == "week":
+            monday = today - timedelta(days=today.weekday()) + timedelta(weeks=shift)
+            return day_span(monday, 7)
+        month_index = today.year * 12 + today.month - 1 + shift
+        year, month = divmod(month_index, 12)
+        n_days = calendar.monthrange(year, month + 1)[1]
+        return day_span(date(year, month + 1, 1), n_days)
+    if kind in ("month_day", "day_month"):
+        prefix = "md" if kind == "month_day" else "dm"
+        year = groups[f"{prefix}_year"]
+        # raises ValueError for impossible dates such as February 30
+        return [
+            date(
+                int(year) if year else today.year,
+                MONTHS[groups[f"{prefix}_month"]],
+                int(groups[f"{prefix}_day"]),
+            )
+        ]
+    if kind == "in_n":
+        days = parse_number(groups["in_count"]) * (
+            7 if groups["in_unit"] == "week" else 1
+        )
+        return [today + timedelta(days=days)]
+    if kind == "n_ago":
+        days = parse_number(groups["ago_count"]) * (
+            7 if groups["ago_unit"] == "week" else 1
+        )
+        return [today - timedelta(days=days)]
+    raise ValueError(f"Unknown date phrase: {match.group()}")
+
+
+def resolve_dates(query: str, formatted_date: str) -> List[str] | None:
+    """Return the dates query refers to, sorted, given today's formatted_date.
+    None means the query has date words the grammar cannot resolve.
+    """
+    today = parse_today(formatted_date)
+    text = " ".join(re.sub(r"[^a-z0-9,.]+", " ", query.lower()).split())
+
+    days = set()
+    try:
+        for match in DATE_PATTERN.finditer(text):
+            days.update(resolve_match(match, today))
+    except ValueError:
+        return None
+
+    remainder = DATE_PATTERN.sub(" ", text)
+    words = re.findall(r"[a-z]+|\d+", remainder)
+    if any(word in DATE_WORDS or word.isdigit() for word in words):
+        return None
+    return [format_date(day) for day in sorted(days)]
+
+
+class ResolverStats:
+    """Counts how many queries the rules resolved and how many went to the LLM."""
+
+    def __init__(self):
+        self.local = 0
+        self.fallback = 0
+        self._lock = threading.Lock()
+
+    def record(self, resolved_locally: bool):
+        with self._lock:
+            if resolved_locally:
+                self.local += 1
+            else:
+                self.fallback += 1
+
+    @property
+    def hit_rate(self) -> float:
+        total = self.local + self.fallback
+        return self.local / total if total else 0.0
+
+    def stats(self) -> Dict:
+        return {
+            "local": self.local,
+            "fallback": self.fallback,
+            "hit_rate": self.hit_rate,
+        }
@@ -3,6 +3,7 @@ from googleapiclient.discovery import build
 import datetime
 import json
 import argparse
+from zoneinfo import ZoneInfo
 
 # Path to your credentials JSON file
 CREDENTIALS_FILE = "credentials.json"
@@ -10,6 +11,21 @@ CREDENTIALS_FILE = "credentials.json"
 # Specify the scopes: URL that indicates Google Calendar API
 SCOPES = ["https://www.googleapis.com/auth/calendar.readonly"]
 
+# Keys kept by --filter, the numeric time columns are used for date lookups in the bot
+KEYS_TO_KEEP = [
+    "id",
+    "date",
+    "start",
+    "start_ts",
+    "end_ts",
+    "utc_offset",
+    "end_utc_offset",
+    "all_day",
+    "location",
+    "summary",
+    "description",
+]
+
 
 def authenticate_google_calendar():
     flow = InstalledAppFlow.from_client_secrets_file(CREDENTIALS_FILE, SCOPES)
@@ -42,32 +58,83 @@ def authenticate_google_calendar():
 #     return events
 
 
-def format_date_description(events):
-    """Add a text description of the date with year included, formatted for easy comparison.
+def parse_event_time(event_time, time_zone="UTC"):
+    """Return a timezone-aware datetime for a Google Calendar start or end value.
+    Timed events have a 'dateTime' with an offset, all-day events only have a 'date',
+    which is taken as midnight in the event's (or the calendar's) time zone.
+    """
+    if "dateTime" in event_time:
+        return datetime.datetime.fromisoformat(
+            event_time["dateTime"].replace("Z", "+00:00")
+        )
+    tz = ZoneInfo(event_time.get("timeZone") or time_zone)
+    return datetime.datetime.fromisoformat(event_time["date"]).replace(tzinfo=tz)
+
+
+def add_timestamps(events, time_zone="UTC"):
+    """Add numeric time columns to each event:
+        'start_ts', 'end_ts': epoch seconds of the start and (exclusive) end,
+        'utc_offset', 'end_utc_offset': offset of the event's local time from UTC at the
+            start and at the end, in seconds (they differ across a DST change),
+        'all_day': True for events that only have a start and end date.
+    """
+    for event in events:
+        start_dt = parse_event_time(event["start"], time_zone)
+        end_dt = parse_event_time(event["end"], time_zone)
+        event["start_ts"] = int(start_dt.timestamp())
+        event["end_ts"] = int(end_dt.timestamp())
+        event["utc_offset"] = int(start_dt.utcoffset().total_seconds())
+        event["end_utc_offset"] = int(end_dt.utcoffset().total_seconds())
+        event["all_day"] = "dateTime" not in event["start"]
+    return events
+
+
+def describe_event_date(event):
+    """Text description of the date of an event with numeric time columns.
 
     For single-day events, format is:
         'Sunday May 12, 2024, 10:30AM-12:30PM'
     For multi-day events, format is:
         'Saturday June 01, 2024, 10:00PM - Sunday June 02, 2024, 10:00AM'.
+    All-day events leave out the times:
+        'Saturday June 01, 2024' or 'Saturday June 01, 2024 - Sunday June 02, 2024'.
     """
+    start_offset = event.get("utc_offset", 0)
+    end_offset = event.get("end_utc_offset", start_offset)
+    start_dt = datetime.datetime.fromtimestamp(
+        event["start_ts"], datetime.timezone(datetime.timedelta(seconds=start_offset))
+    )
+    end_dt = datetime.datetime.fromtimestamp(
+        event["end_ts"], datetime.timezone(datetime.timedelta(seconds=end_offset))
+    )
+
+    if event.get("all_day"):
+        # the end date of an all-day event is exclusive
+        last_day = end_dt - datetime.timedelta(days=1)
+        event_date = start_dt.strftime("%A %B %d, %Y")
+        if last_day.date() <= start_dt.date():
+            return event_date
+        return f"{event_date} - {last_day.strftime('%A %B %d, %Y')}"
+
+    # Check if start and end are on different days
+    if start_dt.date() == end_dt.date():
+        event_date = start_dt.strftime("%A %B %d, %Y, %I:%M%p")
+        event_end_time = end_dt.strftime("%I:%M%p")
+        return f"{event_date}-{event_end_time}"
+    event_date = start_dt.strftime("%A %B %d, %Y, %I:%M%p")
+    event_end_date = end_dt.strftime("%A %B %d, %Y, %I:%M%p")
+    return f"{event_date} - {event_end_date}"
+
+
+def format_date_description(events, time_zone="UTC"):
+    """Add numeric time columns (see add_timestamps) and a text description of the date
+    derived from them (see describe_event_date), with year included, formatted for easy
+    comparison.
+    """
+    events = add_timestamps(events, time_zone)
     for event in events:
-        start_dt = datetime.datetime.fromisoformat(event["start"]["dateTime"])
-        end_dt = datetime.datetime.fromisoformat(event["end"]["dateTime"])
-
-        # Check if start and end are on different days
-        if start_dt.date() == end_dt.date():
-            # Include year in the output
-            event_date = start_dt.strftime("%A %B %d, %Y, %I:%M%p")
-            event_end_time = end_dt.strftime("%I:%M%p")
-            date = f"{event_date}-{event_end_time}"
-        else:
-            # Include year in the output for both start and end times
-            event_date = start_dt.strftime("%A %B %d, %Y, %I:%M%p")
-            event_end_date = end_dt.strftime("%A %B %d, %Y, %I:%M%p")
-            date = f"{event_date} - {event_end_date}"
-
-        event["date"] = date
-        event["start"] = event["start"]["dateTime"]
+        event["date"] = describe_event_date(event)
+        event["start"] = event["start"].get("dateTime", event["start"].get("date"))
 
     return events
 
@@ -143,7 +210,10 @@ def get_calendar_events(past: bool=False, n_events:int = 50):
     if not events:
         print("No upcoming events found.")
 
-    events = format_date_description(events)
+    # all-day events have no offset of their own, use the calendar's time zone
+    events = format_date_description(
+        events, time_zone=events_result.get("timeZone", "UTC")
+    )
 
     for event in events:
         event_date = event["date"]
@@ -173,16 +243,15 @@ if __name__ == "__main__":
         "-f",
         "--filter",
         action="store_true",
-        help=f"Filter calendar events to keep keys: {['id', 'date', 'start', 'location', 'summary', 'description']}.",
+        help=f"Filter calendar events to keep keys: {KEYS_TO_KEEP}.",
     )
 
     args = parser.parse_args()
     # Save events to a JSON file
     events = get_calendar_events(past=args.past, n_events=args.n_events)
     print(f"Retrieving {len(events)} events.")
-    keys_to_keep = ["id", "date", "start", "location", "summary", "description"]
     if args.filter:
-        events = filter_event_keys(events, keys_to_keep)
+        events = filter_event_keys(events, KEYS_TO_KEEP)
     path = args.calendar_path
     with open(path, "w") as f:
         json.dump(events, f, indent=2)
@@ -0,0 +1,145 @@
+"""Micro-batching of query embeddings across concurrent callers.
+
+With several questions in flight (server.py, or --use_async embedding speculatively
+while the intent is classified), each one went through retrieval.get_embeddings on its
+own, so the model ran batch size 1 forward passes back to back. An EmbeddingBatcher
+queues the texts to embed; a worker thread takes the first one, waits up to max_wait
+seconds for more (up to max_batch_size), embeds them with one forward pass and hands
+each caller its row. Identical texts in a batch are embedded once.
+
+The batcher's stats report the queue depth callers found, the batch sizes, and the
+wait time batching added before the forward pass.
+"""
+
+import queue
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future
+from typing import Dict
+
+import numpy as np
+
+from timing import LatencyStats
+
+
+class BatcherStats:
+    def __init__(self, window: int = 1000):
+        # 'wait' is the time from embed() to the start of its forward pass,
+        # 'forward' the duration of the batched forward passes
+        self.latency = LatencyStats(window)
+        self.batch_sizes = deque(maxlen=window)
+        self.queue_depths = deque(maxlen=window)
+        self.n_batches = 0
+        self.n_texts = 0
+        self._lock = threading.Lock()
+
+    def record_submit(self, queue_depth: int):
+        with self._lock:
+            self.queue_depths.append(queue_depth)
+
+    def record_batch(self, batch_size: int, waits, forward_seconds: float):
+        with self._lock:
+            self.n_batches += 1
+            self.n_texts += batch_size
+            self.batch_sizes.append(batch_size)
+        for seconds in waits:
+            self.latency.record("wait", seconds)
+        self.latency.record("forward", forward_seconds)
+
+    def stats(self) -> Dict:
+        with self._lock:
+            batch_sizes = list(self.batch_sizes)
+            queue_depths = list(self.queue_depths)
+        return {
+            "batches": self.n_batches,
+            "texts": self.n_texts,
+            "mean_batch_size": float(np.mean(batch_sizes)) if batch_sizes else 0.0,
+            "max_batch_size": max(batch_sizes, default=0),
+            "mean_queue_depth": float(np.mean(queue_depths)) if queue_depths else 0.0,
+            "max_queue_depth": max(queue_depths, default=0),
+            "wait_p50": self.latency.percentile("wait", 50),
+            "wait_p95": self.latency.percentile("wait", 95),
+            "forward_p50": self.latency.percentile("forward", 50),
+        }
+
+    def report(self) -> str:
+        stats = self.stats()
+        if not stats["batches"]:
+            return "Query embedding batches: none yet"
+        return (
+            f"Query embedding batches: {stats['batches']} for {stats['texts']} queries, "
+            f"mean size {stats['mean_batch_size']:.1f} (max {stats['max_batch_size']}), "
+            f"queue depth mean {stats['mean_queue_depth']:.1f} "
+            f"(max {stats['max_queue_depth']}), "
+            f"added wait p50 {1000 * stats['wait_p50']:.1f} ms "
+            f"p95 {1000 * stats['wait_p95']:.1f} ms, "
+            f"forward pass p50 {1000 * stats['forward_p50']:.1f} ms"
+        )
+
+
+class EmbeddingBatcher:
+    def __init__(self, embedder, max_batch_size: int = 16, max_wait: float = 0.005):
+        self.embedder = embedder
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.stats = BatcherStats()
+        self._queue = queue.Queue()
+        self._thread = None
+        self._start_lock = threading.Lock()
+
+    def _start(self):
+        with self._start_lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, daemon=True)
+                self._thread.start()
+
+    def embed(self, text: str) -> np.ndarray:
+        """Embed text in the next batch, blocking until it is done."""
+        if self._thread is None:
+            self._start()
+        future = Future()
+        self.stats.record_submit(self._queue.qsize())
+        self._queue.put((text, time.perf_counter(), future))
+        return future.result()
+
+    def _collect(self):
+        """The first queued request and those arriving within max_wait after it."""
+        batch = [self._queue.get()]
+        deadline = batch[0][1] + self.max_wait
+        while len(batch) < self.max_batch_size:
+            timeout = deadline - time.perf_counter()
+            try:
+                # take what is already queued even once the window has passed
+                item = (
+                    self._queue.get(timeout=timeout)
+                    if timeout > 0
+                    else self._queue.get_nowait()
+                )
+            except queue.Empty:
+                break
+            batch.append(item)
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._collect()
+            start_time = time.perf_counter()
+            texts = list(dict.fromkeys(text for text, _, _ in batch))
+            try:
+                embeddings = self.embedder.embed_batch(
+                    texts, batch_size=self.max_batch_size
+                )
+            except Exception as e:
+                for _, _, future in batch:
+                    future.set_exception(e)
+                continue
+            forward_seconds = time.perf_counter() - start_time
+            rows = {text: i for i, text in enumerate(texts)}
+            for text, _, future in batch:
+                future.set_result(embeddings[rows[text]])
+            self.stats.record_batch(
+                len(batch),
+                [start_time - submitted for _, submitted, _ in batch],
+                forward_seconds,
+            )
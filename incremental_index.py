@@ -0,0 +1,332 @@
+"""Incremental maintenance of the calendar vector index.
+
+Annoy and HNSW indexes are built once, so instead of rebuilding on every calendar change
+the IncrementalIndex keeps the last built vector store (the "main" index, see
+vector_store) and puts changes in a small mutable delta:
+    - added or edited events are embedded and stored in the delta, which is searched
+      exactly with numpy,
+    - edited or deleted events that are still in the main index are tombstoned and
+      filtered out of its results.
+Events are diffed against the previous snapshot by their `id` and a hash of their
+indexed text, so only changed events are re-embedded. Once the delta grows past
+compaction_threshold entries, a background thread rebuilds the main index from the
+live embeddings, saves it as the new snapshot and swaps it in.
+
+The object answers get_nns_by_vector like an AnnoyIndex whose item ids are the
+index_id of each event, so it can be passed to retrieve_docs in place of one.
+"""
+
+import hashlib
+import json
+import os
+import shutil
+import threading
+import time
+from typing import Dict, List, Set
+
+import numpy as np
+
+from index_cache import DEFAULT_CACHE_DIR, load_index, save_index, write_text_atomic
+from retrieval import doc_to_text, get_batch_embeddings, model_choice
+from vector_store import angular_distances, build_vector_store, select_backend
+
+LATEST_FILE = "LATEST"
+
+
+def text_hash(text: str) -> str:
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+class IncrementalIndex:
+    def __init__(
+        self,
+        text_fields: List[str],
+        cache_dir: str = DEFAULT_CACHE_DIR,
+        model_name: str = model_choice,
+        compaction_threshold: int = 32,
+        backend: str = "auto",
+        target_recall: float = 0.95,
+        n_trees: int = 10,
+        batch_size: int = 32,
+        verbose: bool = False,
+    ):
+        self.text_fields = list(text_fields)
+        self.model_name = model_name
+        self.compaction_threshold = compaction_threshold
+        self.backend = backend
+        self.target_recall = target_recall
+        self.n_trees = n_trees
+        self.batch_size = batch_size
+        self.verbose = verbose
+        key = hashlib.sha256(
+            json.dumps({"fields": self.text_fields, "model": model_name}).encode()
+        ).hexdigest()[:16]
+        self.snapshot_dir = os.path.join(cache_dir, f"incremental-{key}")
+
+        # main index: item i is main_event_ids[i]
+        self.main_index = None
+        self.main_embeddings = None
+        self.main_event_ids: List[str] = []
+        self.main_rows: Dict[str, int] = {}
+        self.tombstones: Set[str] = set()
+        # delta: event id -> embedding, searched exactly
+        self.delta: Dict[str, np.ndarray] = {}
+        # event id -> hash of its indexed text, for diffing the next calendar
+        self.text_hashes: Dict[str, str] = {}
+        # event id -> index_id (position in the current calendar) and back
+        self.positions: Dict[str, int] = {}
+        self.event_ids: Dict[int, str] = {}
+
+        self._lock = threading.RLock()
+        self._compaction_thread = None
+        self._touched_during_compaction: Set[str] | None = None
+
+    @classmethod
+    def open(cls, docs: List[Dict], text_fields: List[str], **kwargs):
+        """Load the latest snapshot for these fields and model and apply docs to it.
+        Without a snapshot every event is embedded and saved as the first one.
+        """
+        index = cls(text_fields, **kwargs)
+        if not index._load_snapshot():
+            index._build_main(docs)
+        index.update(docs)
+        return index
+
+    def _latest_path(self) -> str | None:
+        try:
+            with open(os.path.join(self.snapshot_dir, LATEST_FILE)) as f:
+                return os.path.join(self.snapshot_dir, f.read().strip())
+        except FileNotFoundError:
+            return None
+
+    def _load_snapshot(self) -> bool:
+        path = self._latest_path()
+        cached = load_index(path) if path else None
+        if cached is None:
+            return False
+        index, embeddings, meta = cached
+        self._set_main(index, embeddings, meta["event_ids"])
+        self.text_hashes = dict(meta["text_hashes"])
+        if self.verbose:
+            print(f"Loaded index snapshot {path} ({len(self.main_event_ids)} events)")
+        return True
+
+    def _set_main(self, index, embeddings: np.ndarray, event_ids: List[str]):
+        self.main_index = index
+        self.main_embeddings = embeddings
+        self.main_event_ids = list(event_ids)
+        self.main_rows = {event_id: i for i, event_id in enumerate(event_ids)}
+
+    def _build_main(self, docs: List[Dict]):
+        if not docs:
+            # nothing to index yet, the first events go to the delta
+            return
+        texts = [doc_to_text(doc, self.text_fields) for doc in docs]
+        embeddings = get_batch_embeddings(
+            texts, batch_size=self.batch_size, verbose=self.verbose
+        )
+        event_ids = [doc["id"] for doc in docs]
+        hashes = {doc["id"]: text_hash(text) for doc, text in zip(docs, texts)}
+        index, embeddings = self._save_snapshot(embeddings, event_ids, hashes)
+        self._set_main(index, embeddings, event_ids)
+        self.text_hashes = hashes
+
+    def _save_snapshot(
+        self, embeddings: np.ndarray, event_ids: List[str], hashes: Dict[str, str]
+    ):
+        """Build a vector store over embeddings, save it and point LATEST at it.
+        Returns the memory-mapped (store, embeddings) of the saved snapshot.
+        """
+        if self.backend == "auto":
+            store = select_backend(
+                embeddings, target_recall=self.target_recall, verbose=self.verbose
+            )
+        else:
+            store = build_vector_store(embeddings, self.backend, n_trees=self.n_trees)
+        name = f"{time.time_ns()}-{os.getpid()}"
+        path = os.path.join(self.snapshot_dir, name)
+        meta = {
+            "model": self.model_name,
+            "fields": self.text_fields,
+            "embedding_dim": int(embeddings.shape[1]),
+            "backend": store.name,
+            "n_trees": self.n_trees,
+            "event_ids": list(event_ids),
+            "text_hashes": hashes,
+            "created": time.time(),
+        }
+        save_index(path, embeddings, meta, store)
+        write_text_atomic(os.path.join(self.snapshot_dir, LATEST_FILE), name)
+        self._remove_old_snapshots(keep=2)
+        store, embeddings, _ = load_index(path, n_trees=self.n_trees)
+        return store, embeddings
+
+    def _remove_old_snapshots(self, keep: int):
+        # processes that still map an old snapshot keep their pages after the unlink
+        names = sorted(
+            name
+            for name in os.listdir(self.snapshot_dir)
+            if not name.startswith(".") and name != LATEST_FILE
+        )
+        for name in names[:-keep]:
+            shutil.rmtree(os.path.join(self.snapshot_dir, name), ignore_errors=True)
+
+    def update(self, docs: List[Dict]):
+        """Diff docs against the indexed events by id and re-embed only what changed."""
+        texts = {doc["id"]: doc_to_text(doc, self.text_fields) for doc in docs}
+        new_hashes = {event_id: text_hash(text) for event_id, text in texts.items()}
+        with self._lock:
+            changed = [
+                event_id
+                for event_id, h in new_hashes.items()
+                if self.text_hashes.get(event_id) != h
+            ]
+            deleted = [
+                event_id for event_id in self.text_hashes if event_id not in texts
+            ]
+
+        embeddings = get_batch_embeddings(
+            [texts[event_id] for event_id in changed], batch_size=self.batch_size
+        )
+
+        with self._lock:
+            for event_id in deleted:
+                self.delta.pop(event_id, None)
+                if event_id in self.main_rows:
+                    self.tombstones.add(event_id)
+            for event_id, embedding in zip(changed, embeddings):
+                self.delta[event_id] = embedding
+                if event_id in self.main_rows:
+                    self.tombstones.add(event_id)
+            if self._touched_during_compaction is not None:
+                self._touched_during_compaction.update(changed)
+                self._touched_during_compaction.update(deleted)
+            self.text_hashes = new_hashes
+            self.positions = {doc["id"]: doc["index_id"] for doc in docs}
+            self.event_ids = {doc["index_id"]: doc["id"] for doc in docs}
+            delta_size = len(self.delta) + len(self.tombstones)
+
+        if self.verbose:
+            print(
+                f"Index update: {len(changed)} added or edited, {len(deleted)} deleted, "
+                f"delta size {delta_size}"
+            )
+        if delta_size > self.compaction_threshold:
+            self.compact_in_background()
+
+    def get_n_items(self) -> int:
+        return len(self.positions)
+
+    def get_nns_by_vector(self, vector, n: int, include_distances: bool = False):
+        """Nearest events to vector from the main index and the delta, as index_ids."""
+        vector = np.asarray(vector, dtype=np.float32)
+        with self._lock:
+            main_index, main_event_ids = self.main_index, self.main_event_ids
+            tombstones = set(self.tombstones)
+            delta_ids = list(self.delta)
+            delta_vectors = np.array([self.delta[event_id] for event_id in delta_ids])
+            positions = self.positions
+
+        if n <= 0 or not positions:
+            return ([], []) if include_distances else []
+
+        candidates = []
+        if main_index is not None and main_event_ids:
+            # ask for extra neighbours to make up for the tombstoned ones
+            ids, distances = main_index.get_nns_by_vector(
+                vector, n + len(tombstones), include_distances=True
+            )
+            candidates.extend(
+                (distance, main_event_ids[i])
+                for i, distance in zip(ids, distances)
+                if main_event_ids[i] not in tombstones
+            )
+        if delta_ids:
+            distances = angular_distances(delta_vectors, vector)
+            candidates.extend(zip(distances.tolist(), delta_ids))
+
+        candidates.sort()
+        results = [
+            (positions[event_id], distance)
+            for distance, event_id in candidates
+            if event_id in positions
+        ][:n]
+        if include_distances:
+            return [i for i, _ in results], [d for _, d in results]
+        return [i for i, _ in results]
+
+    def distances(self, vector, rows) -> np.ndarray:
+        """Exact angular distance from vector to the events with the given index_ids."""
+        vector = np.asarray(vector, dtype=np.float32)
+        with self._lock:
+            event_ids = [self.event_ids[row] for row in rows]
+            vectors = np.array(
+                [
+                    (
+                        self.delta[event_id]
+                        if event_id in self.delta
+                        else self.main_embeddings[self.main_rows[event_id]]
+                    )
+                    for event_id in event_ids
+                ],
+                dtype=np.float32,
+            )
+        if not event_ids:
+            return np.zeros(0, dtype=np.float32)
+        return angular_distances(vectors, vector)
+
+    def compact_in_background(self):
+        """Start a compaction thread unless one is already running."""
+        with self._lock:
+            if (
+                self._compaction_thread is not None
+                and self._compaction_thread.is_alive()
+            ):
+                return
+            self._compaction_thread = threading.Thread(target=self.compact, daemon=True)
+            self._compaction_thread.start()
+
+    def compact(self):
+        """Rebuild the main index from the live events and clear the delta.
+        Changes applied while the rebuild runs are kept in the new delta.
+        """
+        start_time = time.time()
+        with self._lock:
+            self._touched_during_compaction = set()
+            live_main = [
+                event_id
+                for event_id in self.main_event_ids
+                if event_id not in self.tombstones and event_id in self.text_hashes
+            ]
+            event_ids = live_main + list(self.delta)
+            rows = [
+                self.main_embeddings[self.main_rows[event_id]] for event_id in live_main
+            ]
+            rows += [self.delta[event_id] for event_id in self.delta]
+            hashes = dict(self.text_hashes)
+
+        if event_ids:
+            embeddings = np.array(rows, dtype=np.float32)
+            index, embeddings = self._save_snapshot(embeddings, event_ids, hashes)
+        else:
+            # every event was deleted, there is no index to build; the previous
+            # snapshot stays the latest and its events are deleted again on load
+            index, embeddings = None, None
+
+        with self._lock:
+            touched = self._touched_during_compaction
+            self._touched_during_compaction = None
+            self._set_main(index, embeddings, event_ids)
+            self.delta = {
+                event_id: embedding
+                for event_id, embedding in self.delta.items()
+                if event_id in touched
+            }
+            self.tombstones = {
+                event_id for event_id in touched if event_id in self.main_rows
+            }
+        if self.verbose:
+            print(
+                f"Compacted index to {len(event_ids)} events in "
+                f"{time.time() - start_time:.2f} seconds"
+            )
@@ -0,0 +1,188 @@
+"""On-disk cache for the calendar embedding matrix and vector index.
+
+Entries are keyed by a hash of the calendar contents, the indexed text fields and the
+embedding model name, so restarting the bot on an unchanged calendar loads the index
+instead of re-embedding every event. An entry holds the embedding matrix and the index
+files of the vector store backends (see vector_store) built for it so far; a backend
+missing from an entry is built from the cached embeddings and added. Files are
+memory-mapped on load (Annoy mmaps its index file, the embeddings are opened with
+np.load(mmap_mode="r")), so several bot processes on the same host share the same pages.
+"""
+
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import time
+from typing import Dict, List, Tuple
+
+import numpy as np
+
+from retrieval import embed_docs, model_choice
+from vector_store import (
+    VectorStore,
+    build_vector_store,
+    load_vector_store,
+    select_backend,
+)
+
+DEFAULT_CACHE_DIR = ".index_cache"
+
+EMBEDDINGS_FILE = "embeddings.npy"
+META_FILE = "meta.json"
+# backend picked by select_backend for an entry, so the benchmark runs once
+AUTO_BACKEND_FILE = "auto_backend"
+
+
+def calendar_hash(docs: List[Dict]) -> str:
+    """Content hash of the calendar, ignoring the index_id assigned at load time."""
+    content = [{k: v for k, v in doc.items() if k != "index_id"} for doc in docs]
+    return hashlib.sha256(
+        json.dumps(content, sort_keys=True).encode("utf-8")
+    ).hexdigest()
+
+
+def cache_key(docs: List[Dict], text_fields: List[str], model_name: str) -> str:
+    key = {
+        "calendar": calendar_hash(docs),
+        "fields": list(text_fields),
+        "model": model_name,
+    }
+    return hashlib.sha256(json.dumps(key, sort_keys=True).encode("utf-8")).hexdigest()[
+        :16
+    ]
+
+
+def write_atomic(path: str, write):
+    """Call write(tmp_path) and rename the result to path."""
+    tmp_path = os.path.join(
+        os.path.dirname(path), f".tmp-{os.getpid()}-{os.path.basename(path)}"
+    )
+    write(tmp_path)
+    os.replace(tmp_path, path)
+
+
+def write_text_atomic(path: str, text: str):
+    def write(tmp_path):
+        with open(tmp_path, "w") as f:
+            f.write(text)
+
+    write_atomic(path, write)
+
+
+def save_index(
+    path: str, embeddings: np.ndarray, meta: Dict, store: VectorStore | None = None
+):
+    """Write the embeddings, metadata and optionally a store's index file to path.
+    Files are written to a temporary directory first and renamed into place, so a
+    concurrent reader never sees a half written entry.
+    """
+    parent = os.path.dirname(path) or "."
+    os.makedirs(parent, exist_ok=True)
+    tmp_path = tempfile.mkdtemp(dir=parent, prefix=".tmp-")
+    try:
+        np.save(os.path.join(tmp_path, EMBEDDINGS_FILE), np.asarray(embeddings))
+        if store is not None and store.index_file:
+            store.save(os.path.join(tmp_path, store.index_file))
+        with open(os.path.join(tmp_path, META_FILE), "w") as f:
+            json.dump(meta, f, indent=2)
+        os.rename(tmp_path, path)
+    except OSError:
+        # another process finished the same entry first, keep theirs
+        if not os.path.exists(os.path.join(path, META_FILE)):
+            raise
+    finally:
+        shutil.rmtree(tmp_path, ignore_errors=True)
+
+
+def load_index(
+    path: str,
+    backend: str | None = None,
+    target_recall: float = 0.95,
+    verbose: bool = False,
+    **params,
+) -> Tuple[VectorStore, np.ndarray, Dict] | None:
+    """Memory-map a cached entry and open a store of the given backend over it.
+    backend defaults to the one recorded in the entry's metadata, "auto" reuses the
+    backend select_backend picked for this entry before, or runs it. A backend without
+    an index file in the entry yet is built and its file added to the entry.
+    Returns None if there is no complete entry at path.
+    """
+    meta_path = os.path.join(path, META_FILE)
+    if not os.path.exists(meta_path):
+        return None
+    with open(meta_path) as f:
+        meta = json.load(f)
+    embeddings = np.load(os.path.join(path, EMBEDDINGS_FILE), mmap_mode="r")
+    backend = backend or meta.get("backend", "annoy")
+
+    if backend == "auto":
+        auto_path = os.path.join(path, AUTO_BACKEND_FILE)
+        if os.path.exists(auto_path):
+            with open(auto_path) as f:
+                backend = f.read().strip()
+        else:
+            store = select_backend(
+                embeddings, target_recall=target_recall, verbose=verbose
+            )
+            backend = store.name
+            if store.index_file:
+                write_atomic(os.path.join(path, store.index_file), store.save)
+            write_text_atomic(auto_path, backend)
+
+    store = load_vector_store(backend, path, embeddings, **params)
+    if store is None:
+        store = build_vector_store(embeddings, backend, **params)
+        write_atomic(os.path.join(path, store.index_file), store.save)
+        # reopen the saved file so this process maps the same pages as later ones
+        store = load_vector_store(backend, path, embeddings, **params)
+    return store, embeddings, meta
+
+
+def load_or_build_index(
+    docs: List[Dict],
+    text_fields: List[str],
+    cache_dir: str = DEFAULT_CACHE_DIR,
+    model_name: str = model_choice,
+    backend: str = "auto",
+    target_recall: float = 0.95,
+    n_trees: int = 10,
+    batch_size: int = 32,
+    verbose: bool = False,
+) -> Tuple[VectorStore, np.ndarray]:
+    """Return (store, embeddings) for docs, from cache_dir if possible.
+    Item i of the store and row i of embeddings correspond to docs[i].
+    """
+    start_time = time.time()
+    path = os.path.join(cache_dir, cache_key(docs, text_fields, model_name))
+
+    if not os.path.exists(os.path.join(path, META_FILE)):
+        embeddings = embed_docs(
+            docs, text_fields, batch_size=batch_size, verbose=verbose
+        )
+        meta = {
+            "model": model_name,
+            "fields": list(text_fields),
+            "calendar_hash": calendar_hash(docs),
+            "n_events": len(docs),
+            "embedding_dim": int(embeddings.shape[1]),
+            "created": time.time(),
+        }
+        save_index(path, embeddings, meta)
+        action = "Built and cached"
+    else:
+        action = "Loaded cached"
+
+    store, embeddings, _ = load_index(
+        path,
+        backend=backend,
+        target_recall=target_recall,
+        verbose=verbose,
+        n_trees=n_trees,
+    )
+    if verbose:
+        print(
+            f"{action} {store.name} index at {path} in {time.time() - start_time:.3f} seconds"
+        )
+    return store, embeddings
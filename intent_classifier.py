@@ -3,15 +3,21 @@ import nest_asyncio
 import json
 import os
 import re
+import threading
 
 from dotenv import load_dotenv
 import langchain
 from langchain_google_genai import ChatGoogleGenerativeAI
 from langchain_core.output_parsers import JsonOutputParser, PydanticOutputParser
-from langchain_core.prompts import PromptTemplate
 
 from pydantic import BaseModel, Field
-from typing import Literal
+from typing import Dict, List, Literal, Tuple
+
+import numpy as np
+
+from date_rules import ResolverStats
+from llm_cache import LLMResultCache, acached_invoke, cached_invoke
+from prepared_chain import PreparedChain
 
 load_dotenv()
 
@@ -109,41 +115,211 @@ class Intent(BaseModel):
 #         )
 #     )
 
+TEST_QUERIES = [
+    ("What's today's date?", "ask_date"),
+    ("What day is it today?", "ask_date"),
+    ("Can you tell me what today is?", "ask_date"),
+    ("What do I have going on today?", "calendar_qa"),
+    ("When is my next class?", "calendar_qa"),
+    ("Where is my Conversational AI class?", "calendar_qa"),
+    ("What is my schedule like on June 25th?", "calendar_qa"),
+    ("What is happening today?", "calendar_qa"),
+    ("What is going on this weekend?", "calendar_qa"),
+    ("What is going on next week?", "calendar_qa"),
+    ("Do I have any meetings scheduled for tomorrow?", "calendar_qa"),
+    ("Can you show me my agenda for the next week?", "calendar_qa"),
+    ("What is the current day of the week?", "ask_date"),
+    ("When is my doctor's appointment?", "calendar_qa"),
+    ("Tell me what's on my calendar for December 25th.", "calendar_qa"),
+    ("Is there anything planned for this Friday evening?", "calendar_qa"),
+    ("How many weeks until New Year?", "out_of_scope"),
+    ("Where is the location of my next meeting?", "calendar_qa"),
+    ("What day of the week is Valentine's Day on next year?", "out_of_scope"),
+    ("Are there any holidays coming up in next week?", "calendar_qa"),
+    ("Show me the events for the last weekend", "calendar_qa"),
+    ("When does daylight saving time begin?", "calendar_qa"),
+    ("What appointments do I have next Monday?", "calendar_qa"),
+    ("What is the date of the next full moon?", "out_of_scope"),
+    ("Can you find my workout schedule?", "calendar_qa"),
+    ("How old are you?", "out_of_scope"),
+    ("What ingredients are in a Margarita?", "out_of_scope"),
+    ("I need a recipe for a chocolate cake.", "out_of_scope"),
+    ("When was the War of 1812?", "out_of_scope"),
+    ("What's the date today?", "ask_date"),
+    ("Do I have any appointments this afternoon?", "calendar_qa"),
+    ("Can you check if I have plans next Saturday?", "calendar_qa"),
+    ("Is today a holiday?", "ask_date"),
+    ("What time is my flight tomorrow?", "calendar_qa"),
+    ("When is my yoga class scheduled?", "calendar_qa"),
+    ("Do I have any events on my birthday?", "calendar_qa"),
+    ("What are the dates for the school holidays this year?", "calendar_qa"),
+    ("What's happening on the first Monday of next month?", "calendar_qa"),
+    ("Who am I meeting with on Wednesday?", "calendar_qa"),
+    ("Is there a board meeting next week?", "calendar_qa"),
+    ("Can you show me the schedule for next month?", "calendar_qa"),
+    ("What events do I have this weekend?", "calendar_qa"),
+    ("What’s the weather like today?", "out_of_scope"),
+    ("Can you book tickets for the movie tonight?", "out_of_scope"),
+    ("Where is the nearest movie theatre?", "out_of_scope"),
+    ("Give me directions to the nearest coffee shop.", "out_of_scope"),
+    ("Can you play some music?", "out_of_scope"),
+    ("I need help with my homework.", "out_of_scope"),
+    ("What are the symptoms of the flu?", "out_of_scope"),
+]
+
+
+def prompt_examples() -> List[Tuple[str, str]]:
+    """The (input, intent) examples of INTENT_CLASSIFICATION_PROMPT, without the
+    placeholder ones such as "Where is [EVENT]?".
+    """
+    pairs = re.findall(
+        r'\*\*Input\*\*: "(.+?)"\s+\*\*Output\*\*: \{\{\'intent\': \'(\w+)\'\}\}',
+        INTENT_CLASSIFICATION_PROMPT,
+    )
+    return [(text, intent) for text, intent in pairs if "[" not in text]
+
+
+class LocalIntentClassifier:
+    """k-nearest-neighbour intent classifier over sentence embeddings of labeled
+    examples, using the embedder of retrieval (so a classified query's embedding is
+    cached for its retrieval too). The examples are embedded on first use.
+    """
+
+    def __init__(
+        self,
+        examples: List[Tuple[str, str]],
+        k: int = 5,
+        threshold: float = 0.8,
+        min_similarity: float = 0.5,
+    ):
+        # the same text may be in both the prompt and the test queries
+        self.examples = list(dict(examples).items())
+        self.k = k
+        self.threshold = threshold
+        self.min_similarity = min_similarity
+        self._embeddings = None
+        self._lock = threading.Lock()
+
+    def _example_embeddings(self) -> np.ndarray:
+        if self._embeddings is None:
+            with self._lock:
+                if self._embeddings is None:
+                    from retrieval import get_batch_embeddings
+
+                    embeddings = get_batch_embeddings([t for t, _ in self.examples])
+                    self._embeddings = embeddings / np.linalg.norm(
+                        embeddings, axis=1, keepdims=True
+                    )
+        return self._embeddings
+
+    def predict(self, query: str, exclude: str | None = None) -> Tuple[str, float]:
+        """Return the intent and its confidence: the similarity-weighted share of the
+        k nearest examples voting for it, 0 if even the nearest one is not similar.
+        The example with the text exclude, if any, does not vote.
+        """
+        from retrieval import get_embeddings
+
+        embeddings = self._example_embeddings()
+        query_embedding = np.asarray(get_embeddings(query), dtype=np.float32)
+        similarities = embeddings @ (query_embedding / np.linalg.norm(query_embedding))
+        for i, (text, _) in enumerate(self.examples):
+            if text == exclude:
+                similarities[i] = -np.inf
+        nearest = np.argsort(-similarities)[: self.k]
+        votes = {}
+        for i in nearest:
+            intent = self.examples[i][1]
+            votes[intent] = votes.get(intent, 0.0) + max(float(similarities[i]), 0.0)
+        intent = max(votes, key=votes.get)
+        if similarities[nearest[0]] < self.min_similarity:
+            return intent, 0.0
+        return intent, votes[intent] / max(sum(votes.values()), 1e-12)
+
+    def leave_one_out(self) -> Dict:
+        """Classify each example with the others only, as the bot would a new phrasing,
+        and return how many were confident enough to skip the LLM and how many of
+        those were right.
+        """
+        n_local = n_correct = 0
+        for text, expected in self.examples:
+            intent, confidence = self.predict(text, exclude=text)
+            if confidence >= self.threshold:
+                n_local += 1
+                n_correct += intent == expected
+        return {"examples": len(self.examples), "local": n_local, "correct": n_correct}
+
+
+local_classifier = LocalIntentClassifier(prompt_examples() + TEST_QUERIES)
+# how many queries the local classifier answered without the LLM
+intent_stats = ResolverStats()
+
+
 # parser = StringOutputParser()
 # parser = JsonOutputParser(pydantic_object=Intent)
 intent_parser = PydanticOutputParser(pydantic_object=Intent)
 
 
-def classify_intent(
-    query: str,
+def intent_chain(
     llm: ChatGoogleGenerativeAI,
     parser: PydanticOutputParser | JsonOutputParser = intent_parser,
-    verbose: bool = False,
-):
+) -> PreparedChain:
+    """The intent classification chain, to build once and pass to classify_intent."""
+    return PreparedChain(INTENT_CLASSIFICATION_PROMPT, ["query"], parser, llm)
 
-    # first try this
-    try:
-        prompt = PromptTemplate(
-            template=INTENT_CLASSIFICATION_PROMPT,
-            input_variables=["query"],
-            partial_variables={"format_instructions": parser.get_format_instructions()},
+
+def classify_locally(query: str, verbose: bool = False) -> Intent | None:
+    """The local_classifier's intent for query, None if it is not confident."""
+    intent, confidence = local_classifier.predict(query)
+    confident = confidence >= local_classifier.threshold
+    intent_stats.record(confident)
+    if not confident:
+        return None
+    response = Intent(intent=intent)
+    if verbose:
+        print(
+            f"Query: '{query}' \n -> Classified Intent (local, {confidence:.2f}): {response.intent}"
         )
-        chain = prompt | llm | parser
-
-        response = chain.invoke({"query": query})
-    except:
-        # if we don't get a response, try again with this
-        prompt = PromptTemplate(
-            template=INTENT_CLASSIFICATION_PROMPT,
-            input_variables=["query"],
-        ).partial(
-            format_instructions=parser.get_format_instructions(),
-            pattern=re.compile(r"\`\`\`\n\`\`\`"),
+    return response
+
+
+def guess_locally(query: str, verbose: bool = False) -> Intent:
+    """The local_classifier's best intent for query, however unsure, for when the LLM
+    missed its deadline.
+    """
+    intent, confidence = local_classifier.predict(query)
+    if verbose:
+        print(
+            f"Query: '{query}' \n -> Classified Intent (local guess, {confidence:.2f}): {intent}"
         )
+    return Intent(intent=intent)
 
-        chain = prompt | llm | parser
 
-        response = chain.invoke({"query": query})
+def classify_intent(
+    query: str,
+    llm: ChatGoogleGenerativeAI,
+    parser: PydanticOutputParser | JsonOutputParser = intent_parser,
+    verbose: bool = False,
+    use_local: bool = True,
+    cache: LLMResultCache | None = None,
+    prepared: PreparedChain | None = None,
+):
+    """Classify the intent of query.
+    With use_local the local_classifier answers when its confidence reaches its
+    threshold, the LLM is only called otherwise. With a cache, LLM answers are looked
+    up in and saved to it. prepared is the chain from intent_chain, built here if
+    not given. If the LLM misses its deadline the local_classifier's guess is used.
+    """
+    if use_local:
+        response = classify_locally(query, verbose)
+        if response is not None:
+            return response
+    prepared = prepared or intent_chain(llm, parser)
+    try:
+        # the intent prompt does not depend on today's date
+        response = cached_invoke(cache, "intent", query, "", prepared, {"query": query})
+    except TimeoutError as e:
+        print(f"{e}, using the local classifier's guess")
+        return guess_locally(query, verbose)
 
     if verbose:
         # print(
@@ -154,6 +330,36 @@ def classify_intent(
     return response
 
 
+async def aclassify_intent(
+    query: str,
+    llm: ChatGoogleGenerativeAI,
+    parser: PydanticOutputParser | JsonOutputParser = intent_parser,
+    verbose: bool = False,
+    use_local: bool = True,
+    cache: LLMResultCache | None = None,
+    prepared: PreparedChain | None = None,
+) -> Intent:
+    """classify_intent without blocking the event loop: the local classifier (a
+    forward pass) runs in a worker thread and the LLM is called with ainvoke.
+    """
+    if use_local:
+        response = await asyncio.to_thread(classify_locally, query, verbose)
+        if response is not None:
+            return response
+    prepared = prepared or intent_chain(llm, parser)
+    try:
+        response = await acached_invoke(
+            cache, "intent", query, "", prepared, {"query": query}
+        )
+    except TimeoutError as e:
+        print(f"{e}, using the local classifier's guess")
+        return await asyncio.to_thread(guess_locally, query, verbose)
+
+    if verbose:
+        print(f"Query: '{query}' \n -> Classified Intent: {response.intent}")
+    return response
+
+
 if __name__ == "__main__":
 
     gemini_llm = ChatGoogleGenerativeAI(
@@ -162,61 +368,12 @@ if __name__ == "__main__":
     # intent_parser = JsonOutputParser(pydantic_object=Intent)
     intent_parser = PydanticOutputParser(pydantic_object=Intent)
 
-    test_queries = [
-        ("What's today's date?", "ask_date"),
-        ("What day is it today?", "ask_date"),
-        ("Can you tell me what today is?", "ask_date"),
-        ("What do I have going on today?", "calendar_qa"),
-        ("When is my next class?", "calendar_qa"),
-        ("Where is my Conversational AI class?", "calendar_qa"),
-        ("What is my schedule like on June 25th?", "calendar_qa"),
-        ("What is happening today?", "calendar_qa"),
-        ("What is going on this weekend?", "calendar_qa"),
-        ("What is going on next week?", "calendar_qa"),
-        ("Do I have any meetings scheduled for tomorrow?", "calendar_qa"),
-        ("Can you show me my agenda for the next week?", "calendar_qa"),
-        ("What is the current day of the week?", "ask_date"),
-        ("When is my doctor's appointment?", "calendar_qa"),
-        ("Tell me what's on my calendar for December 25th.", "calendar_qa"),
-        ("Is there anything planned for this Friday evening?", "calendar_qa"),
-        ("How many weeks until New Year?", "out_of_scope"),
-        ("Where is the location of my next meeting?", "calendar_qa"),
-        ("What day of the week is Valentine's Day on next year?", "out_of_scope"),
-        ("Are there any holidays coming up in next week?", "calendar_qa"),
-        ("Show me the events for the last weekend", "calendar_qa"),
-        ("When does daylight saving time begin?", "calendar_qa"),
-        ("What appointments do I have next Monday?", "calendar_qa"),
-        ("What is the date of the next full moon?", "out_of_scope"),
-        ("Can you find my workout schedule?", "calendar_qa"),
-        ("How old are you?", "out_of_scope"),
-        ("What ingredients are in a Margarita?", "out_of_scope"),
-        ("I need a recipe for a chocolate cake.", "out_of_scope"),
-        ("When was the War of 1812?", "out_of_scope"),
-        ("What's the date today?", "ask_date"),
-        ("Do I have any appointments this afternoon?", "calendar_qa"),
-        ("Can you check if I have plans next Saturday?", "calendar_qa"),
-        ("Is today a holiday?", "ask_date"),
-        ("What time is my flight tomorrow?", "calendar_qa"),
-        ("When is my yoga class scheduled?", "calendar_qa"),
-        ("Do I have any events on my birthday?", "calendar_qa"),
-        ("What are the dates for the school holidays this year?", "calendar_qa"),
-        ("What's happening on the first Monday of next month?", "calendar_qa"),
-        ("Who am I meeting with on Wednesday?", "calendar_qa"),
-        ("Is there a board meeting next week?", "calendar_qa"),
-        ("Can you show me the schedule for next month?", "calendar_qa"),
-        ("What events do I have this weekend?", "calendar_qa"),
-        ("What’s the weather like today?", "out_of_scope"),
-        ("Can you book tickets for the movie tonight?", "out_of_scope"),
-        ("Where is the nearest movie theatre?", "out_of_scope"),
-        ("Give me directions to the nearest coffee shop.", "out_of_scope"),
-        ("Can you play some music?", "out_of_scope"),
-        ("I need help with my homework.", "out_of_scope"),
-        ("What are the symptoms of the flu?", "out_of_scope"),
-    ]
     verbose = True
 
-    for idx, query in enumerate(test_queries):
-        response = classify_intent(query[0], gemini_llm, intent_parser, verbose)
+    for idx, query in enumerate(TEST_QUERIES):
+        response = classify_intent(
+            query[0], gemini_llm, intent_parser, verbose, use_local=False
+        )
         # response["ground_truth"] = query[1]
         # response["query"] = query[0]
         # Save response to JSON file
@@ -227,3 +384,15 @@ if __name__ == "__main__":
         }
         with open(f"query_data/intent_classification_{idx}.json", "w") as f:
             json.dump(query_data, f, indent=2)
+
+    # the test queries are examples of the local classifier, each one would be its own
+    # nearest neighbour, so evaluate it on the examples it was not given
+    evaluation = local_classifier.leave_one_out()
+    print(
+        f"Leave-one-out, the local classifier answered {evaluation['local']} of "
+        f"{evaluation['examples']} examples without the LLM "
+        f"({100 * evaluation['local'] / evaluation['examples']:.0f}%), "
+        f"{evaluation['correct']} of them correctly "
+        f"(threshold {local_classifier.threshold}, "
+        f"min_similarity {local_classifier.min_similarity})"
+    )
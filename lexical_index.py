@@ -0,0 +1,122 @@
+"""BM25 lexical index over the calendar text fields.
+
+Many questions name the event directly ('When do Arsenal play', 'Where is my
+Conversational AI class?'), and for those an exact word match is cheaper than a
+transformer forward pass and often more precise. The BM25Index is an inverted index
+from each term to the events containing it, with the BM25 weight of every posting
+computed at build time, so a search only touches the postings of the query terms.
+
+reciprocal_rank_fusion merges its ranking with the SBERT one in retrieve_docs, and
+is_confident tells retrieve_docs when the lexical match is good enough to skip the
+query embedding altogether.
+"""
+
+import math
+import re
+from typing import Dict, Iterable, List, Tuple
+
+TOKEN_PATTERN = re.compile(r"[a-z0-9]+")
+
+# question words and fillers that say nothing about which event is meant
+STOPWORDS = {
+    "a", "about", "am", "an", "and", "any", "anything", "are", "at", "be", "can",
+    "did", "do", "does", "for", "from", "going", "have", "having", "how", "i", "in",
+    "is", "it", "me", "my", "next", "of", "on", "or", "s", "the", "there", "this",
+    "to", "today", "tomorrow", "was", "week", "weekend", "what", "whats", "when",
+    "where", "which", "who", "will", "with", "you", "your",
+}  # fmt: skip
+
+
+def tokenize(text: str) -> List[str]:
+    return [
+        token
+        for token in TOKEN_PATTERN.findall(text.lower().replace("'", ""))
+        if token not in STOPWORDS
+    ]
+
+
+class BM25Index:
+    def __init__(
+        self, docs: List[Dict], text_fields: List[str], k1: float = 1.5, b: float = 0.75
+    ):
+        self.text_fields = list(text_fields)
+        doc_terms = {}
+        for doc in docs:
+            text = " ".join(str(doc.get(field, "")) for field in text_fields)
+            doc_terms[doc["index_id"]] = tokenize(text)
+
+        n_docs = max(len(doc_terms), 1)
+        avg_len = sum(len(terms) for terms in doc_terms.values()) / n_docs or 1.0
+
+        term_freqs: Dict[str, Dict[int, int]] = {}
+        for doc_id, terms in doc_terms.items():
+            for term in terms:
+                freqs = term_freqs.setdefault(term, {})
+                freqs[doc_id] = freqs.get(doc_id, 0) + 1
+
+        # term -> [(index_id, bm25 weight of the term in that doc)]
+        self.postings: Dict[str, List[Tuple[int, float]]] = {}
+        for term, freqs in term_freqs.items():
+            idf = math.log(1 + (n_docs - len(freqs) + 0.5) / (len(freqs) + 0.5))
+            self.postings[term] = [
+                (
+                    doc_id,
+                    idf
+                    * tf
+                    * (k1 + 1)
+                    / (tf + k1 * (1 - b + b * len(doc_terms[doc_id]) / avg_len)),
+                )
+                for doc_id, tf in freqs.items()
+            ]
+
+    def search(
+        self, query: str, top_n: int, exclude_ids: Iterable[int] = frozenset()
+    ) -> Tuple[List[Tuple[int, float]], Dict[int, int]]:
+        """Return the top_n (index_id, bm25_score) by descending score, skipping
+        index_ids in exclude_ids, and for each returned doc the number of distinct query
+        terms it contains.
+        """
+        scores: Dict[int, float] = {}
+        matched: Dict[int, int] = {}
+        for term in set(tokenize(query)):
+            for doc_id, weight in self.postings.get(term, []):
+                if doc_id in exclude_ids:
+                    continue
+                scores[doc_id] = scores.get(doc_id, 0.0) + weight
+                matched[doc_id] = matched.get(doc_id, 0) + 1
+        ranked = sorted(scores.items(), key=lambda item: (-item[1], item[0]))[:top_n]
+        return ranked, {doc_id: matched[doc_id] for doc_id, _ in ranked}
+
+    def is_confident(
+        self,
+        query: str,
+        results: List[Tuple[int, float]],
+        matched_terms: Dict[int, int],
+        min_terms: int = 2,
+        min_coverage: float = 0.5,
+        min_margin: float = 1.2,
+    ) -> bool:
+        """Whether the best lexical match (results and matched_terms as returned by
+        search) is clear enough to skip the semantic search: it contains at least
+        min_terms distinct query terms and min_coverage of them, and its score is at
+        least min_margin times the runner-up's. A single matching word is not enough.
+        """
+        n_terms = len(set(tokenize(query)))
+        if not n_terms or not results:
+            return False
+        best_id, best_score = results[0]
+        n_matched = matched_terms[best_id]
+        if n_matched < min_terms or n_matched / n_terms < min_coverage:
+            return False
+        return len(results) == 1 or best_score >= min_margin * results[1][1]
+
+
+def reciprocal_rank_fusion(
+    rankings: List[List[int]], k: int = 60
+) -> List[Tuple[int, float]]:
+    """Fuse rankings of index_ids, best first, into one by summing 1 / (k + rank)."""
+    scores: Dict[int, float] = {}
+    for ranking in rankings:
+        for rank, doc_id in enumerate(ranking, start=1):
+            scores[doc_id] = scores.get(doc_id, 0.0) + 1.0 / (k + rank)
+    return sorted(scores.items(), key=lambda item: (-item[1], item[0]))
@@ -0,0 +1,280 @@
+"""Persistent SQLite cache of LLM intent and date extraction results.
+
+The same questions are asked day after day, and what the LLM answers for them only
+depends on the question, today's date (for dates), the prompt and the model. Entries are
+keyed by all four, the prompt through a hash of its template and format instructions
+(prompt_version), so editing one prompt only invalidates the entries made with it.
+Intent classification does not see today's date, so its entries are shared across days.
+
+Entries expire after ttl_seconds and the least recently used ones are evicted beyond
+max_entries. Inspect or clean the cache with
+    python llm_cache.py stats
+    python llm_cache.py evict
+    python llm_cache.py clear [--kind dates]
+"""
+
+import argparse
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from typing import Dict
+
+from llm_client import outcome_config
+from query_cache import normalize_query
+
+DEFAULT_LLM_CACHE_PATH = ".llm_cache.sqlite"
+DEFAULT_TTL_SECONDS = 30 * 24 * 3600
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS results (
+    key TEXT PRIMARY KEY,
+    kind TEXT NOT NULL,
+    prompt_version TEXT NOT NULL,
+    model TEXT NOT NULL,
+    query TEXT NOT NULL,
+    today TEXT NOT NULL,
+    value TEXT NOT NULL,
+    created REAL NOT NULL,
+    last_used REAL NOT NULL,
+    hits INTEGER NOT NULL DEFAULT 0
+)
+"""
+
+
+def prompt_version(*parts: str) -> str:
+    """Short hash of a prompt template and its format instructions."""
+    return hashlib.sha256("\0".join(parts).encode("utf-8")).hexdigest()[:12]
+
+
+def model_name(llm) -> str:
+    return getattr(llm, "model", None) or type(llm).__name__
+
+
+class LLMResultCache:
+    def __init__(
+        self,
+        path: str = DEFAULT_LLM_CACHE_PATH,
+        max_entries: int = 10000,
+        ttl_seconds: float = DEFAULT_TTL_SECONDS,
+    ):
+        self.path = path
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.hits = 0
+        self.misses = 0
+        # the bot calls the cache from worker threads too
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute(SCHEMA)
+        self._db.commit()
+        # kept up to date by put and evict, so writes do not count the table
+        self._n_entries = self._count()
+
+    @staticmethod
+    def key(kind: str, query: str, today: str, version: str, model: str) -> str:
+        return hashlib.sha256(
+            json.dumps([kind, normalize_query(query), today, version, model]).encode()
+        ).hexdigest()
+
+    def get(
+        self, kind: str, query: str, today: str, version: str, model: str
+    ) -> Dict | None:
+        """The cached result as a dict, None if missing or expired."""
+        key = self.key(kind, query, today, version, model)
+        now = time.time()
+        with self._lock:
+            row = self._db.execute(
+                "SELECT value FROM results WHERE key = ? AND created > ?",
+                (key, now - self.ttl_seconds),
+            ).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._db.execute(
+                "UPDATE results SET last_used = ?, hits = hits + 1 WHERE key = ?",
+                (now, key),
+            )
+            self._db.commit()
+        return json.loads(row[0])
+
+    def put(self, kind: str, query: str, today: str, version: str, model: str, value):
+        """Store value, a pydantic model or a dict."""
+        if hasattr(value, "model_dump"):
+            value = value.model_dump()
+        elif hasattr(value, "dict"):
+            value = value.dict()
+        key = self.key(kind, query, today, version, model)
+        now = time.time()
+        with self._lock:
+            exists = self._db.execute(
+                "SELECT 1 FROM results WHERE key = ?", (key,)
+            ).fetchone()
+            self._db.execute(
+                "INSERT OR REPLACE INTO results "
+                "(key, kind, prompt_version, model, query, today, value, created, last_used) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (
+                    key,
+                    kind,
+                    version,
+                    model,
+                    normalize_query(query),
+                    today,
+                    json.dumps(value),
+                    now,
+                    now,
+                ),
+            )
+            self._db.commit()
+            if not exists:
+                self._n_entries += 1
+        if self.max_entries and self._n_entries > self.max_entries:
+            # make room for a tenth more so a full cache is not evicted on every put
+            self.evict(keep=self.max_entries - self.max_entries // 10)
+
+    def _count(self) -> int:
+        with self._lock:
+            return self._db.execute("SELECT COUNT(*) FROM results").fetchone()[0]
+
+    def evict(self, keep: int | None = None) -> int:
+        """Drop expired entries and the least recently used ones beyond keep
+        (max_entries by default). Returns the number of entries removed.
+        """
+        keep = self.max_entries if keep is None else keep
+        with self._lock:
+            removed = self._db.execute(
+                "DELETE FROM results WHERE created <= ?",
+                (time.time() - self.ttl_seconds,),
+            ).rowcount
+            if keep:
+                removed += self._db.execute(
+                    "DELETE FROM results WHERE key NOT IN "
+                    "(SELECT key FROM results ORDER BY last_used DESC LIMIT ?)",
+                    (keep,),
+                ).rowcount
+            self._db.commit()
+        # other processes may share the database, recount
+        self._n_entries = self._count()
+        return removed
+
+    def clear(self, kind: str | None = None) -> int:
+        with self._lock:
+            if kind is None:
+                removed = self._db.execute("DELETE FROM results").rowcount
+            else:
+                removed = self._db.execute(
+                    "DELETE FROM results WHERE kind = ?", (kind,)
+                ).rowcount
+            self._db.commit()
+        self._n_entries = self._count()
+        return removed
+
+    def stats(self) -> Dict:
+        """Entries and stored hits per kind, plus this process's hits and misses."""
+        with self._lock:
+            rows = self._db.execute(
+                "SELECT kind, COUNT(*), SUM(hits), COUNT(DISTINCT prompt_version) "
+                "FROM results GROUP BY kind"
+            ).fetchall()
+        lookups = self.hits + self.misses
+        return {
+            "path": self.path,
+            "size_bytes": (
+                os.path.getsize(self.path) if os.path.exists(self.path) else 0
+            ),
+            "kinds": {
+                kind: {"entries": n, "hits": hits or 0, "prompt_versions": versions}
+                for kind, n, hits, versions in rows
+            },
+            "session_hits": self.hits,
+            "session_misses": self.misses,
+            "session_hit_rate": self.hits / lookups if lookups else 0.0,
+        }
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+
+def cached_invoke(
+    cache: LLMResultCache | None, kind: str, query: str, today: str, prepared, inputs
+):
+    """prepared.invoke(inputs) through cache: the cached result for query if there is
+    one, otherwise the LLM's, which is then cached. prepared is a PreparedChain, whose
+    parser's pydantic_object the cached dict is turned back into. Errors propagate and
+    are not cached, nor are answers of the fallback model (see llm_client), which
+    would otherwise be served as the primary model's.
+    """
+    if cache is None:
+        return prepared.invoke(inputs)
+    cache_args = (kind, query, today, prepared.version, prepared.model)
+    cached = cache.get(*cache_args)
+    if cached is not None:
+        return prepared.parser.pydantic_object(**cached)
+    outcome = {}
+    response = prepared.invoke(inputs, outcome_config(outcome))
+    if outcome.get("outcome") != "fallback":
+        cache.put(*cache_args, response)
+    return response
+
+
+async def acached_invoke(
+    cache: LLMResultCache | None, kind: str, query: str, today: str, prepared, inputs
+):
+    """cached_invoke calling prepared.ainvoke."""
+    if cache is None:
+        return await prepared.ainvoke(inputs)
+    cache_args = (kind, query, today, prepared.version, prepared.model)
+    cached = cache.get(*cache_args)
+    if cached is not None:
+        return prepared.parser.pydantic_object(**cached)
+    outcome = {}
+    response = await prepared.ainvoke(inputs, outcome_config(outcome))
+    if outcome.get("outcome") != "fallback":
+        cache.put(*cache_args, response)
+    return response
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Inspect or clean the LLM intent and date extraction cache."
+    )
+    parser.add_argument("command", choices=["stats", "evict", "clear"])
+    parser.add_argument(
+        "--path",
+        default=DEFAULT_LLM_CACHE_PATH,
+        help=f"Cache database. Default is '{DEFAULT_LLM_CACHE_PATH}'.",
+    )
+    parser.add_argument(
+        "--kind",
+        choices=["intent", "dates", "fused"],
+        help="With clear, only remove entries of this kind.",
+    )
+    parser.add_argument(
+        "--ttl_days",
+        default=DEFAULT_TTL_SECONDS / (24 * 3600),
+        type=float,
+        help="With evict, remove entries older than this many days.",
+    )
+    args = parser.parse_args()
+
+    cache = LLMResultCache(args.path, ttl_seconds=args.ttl_days * 24 * 3600)
+    if args.command == "stats":
+        stats = cache.stats()
+        print(f"{stats['path']}: {stats['size_bytes'] / 1024:.1f} KiB")
+        for kind, kind_stats in sorted(stats["kinds"].items()):
+            print(
+                f"\t{kind:<6} {kind_stats['entries']:6d} entries, "
+                f"{kind_stats['hits']:6d} hits, "
+                f"{kind_stats['prompt_versions']} prompt version(s)"
+            )
+    elif args.command == "evict":
+        print(f"Evicted {cache.evict()} entries.")
+    else:
+        print(f"Removed {cache.clear(args.kind)} entries.")
+    cache.close()
@@ -0,0 +1,273 @@
+"""Gemini calls with a deadline, a hedged duplicate request and a faster fallback model.
+
+LLMClient.stage(name) returns a Runnable to use in place of the chat model in a chain
+(see pipeline.Pipeline). Each call of a stage
+    - sends the request to the primary model,
+    - sends it again (a hedge) if no answer came after the stage's observed p95
+      latency, or a quarter of its deadline until enough calls have been seen,
+    - also asks the fallback model (e.g. gemini-1.5-flash) once half of the deadline
+      has passed,
+and returns the first answer, cancelling the others. A call still unanswered at the
+deadline raises TimeoutError. Latencies and which request answered are recorded per
+stage in client.stats (timing.LatencyStats), so one slow request no longer sets the
+p99 of a turn.
+
+Every request runs on one event loop on its own thread (llm_loop), whichever loop or
+thread the call comes from, and a losing or timed-out request is cancelled there. That
+only stops the HTTP call if the model has a native async client: ChatGoogleGenerativeAI
+creates one only when built with a running event loop, so build it with
+create_on_llm_loop. Otherwise its ainvoke runs the sync call in a worker thread, which
+cancelling cannot stop.
+
+Which request answered is also written to the outcome dict a caller puts in the call's
+config metadata under OUTCOME_KEY (see outcome_config), for llm_cache not to store
+answers of the fallback model under the primary model.
+"""
+
+import asyncio
+import threading
+import time
+from typing import Dict, List, Tuple
+
+from langchain_core.runnables import Runnable
+
+from timing import LatencyStats
+
+DEFAULT_DEADLINES = {
+    "intent": 8.0,
+    "dates": 8.0,
+    "fused": 10.0,
+    "answer": 30.0,
+    "summary": 30.0,
+}
+# before this many calls of a stage its p95 is not trusted for the hedge delay
+MIN_SAMPLES = 20
+HEDGE_AT = 0.25
+FALLBACK_AT = 0.5
+OUTCOME_KEY = "llm_outcome"
+
+
+def parse_deadlines(text: str) -> Dict[str, float]:
+    """Parse 'intent=5,answer=20' into per-stage deadlines in seconds."""
+    deadlines = {}
+    for item in text.split(","):
+        stage, _, seconds = item.partition("=")
+        if stage.strip() not in DEFAULT_DEADLINES or not seconds:
+            raise ValueError(
+                f"Expected stage=seconds with a stage in {list(DEFAULT_DEADLINES)}, got '{item}'"
+            )
+        deadlines[stage.strip()] = float(seconds)
+    return deadlines
+
+
+def outcome_config(outcome: Dict) -> Dict:
+    """Config for a chain call, after which outcome["outcome"] is the label of the
+    request that answered ('primary', 'hedge' or 'fallback') if a StageLLM was called.
+    """
+    return {"metadata": {OUTCOME_KEY: outcome}}
+
+
+_loop = None
+_loop_lock = threading.Lock()
+
+
+def llm_loop() -> asyncio.AbstractEventLoop:
+    """The event loop every StageLLM request runs on, started on first use."""
+    global _loop
+    with _loop_lock:
+        if _loop is None:
+            _loop = asyncio.new_event_loop()
+            threading.Thread(target=_loop.run_forever, daemon=True).start()
+    return _loop
+
+
+def run_on_llm_loop(coroutine):
+    """Run coroutine on llm_loop and wait for its result."""
+    return asyncio.run_coroutine_threadsafe(coroutine, llm_loop()).result()
+
+
+def create_on_llm_loop(factory, *args, **kwargs):
+    """factory(*args, **kwargs) called on llm_loop, so that a model which creates its
+    async client only inside a running event loop creates it for the loop its requests
+    run on.
+    """
+
+    async def create():
+        return factory(*args, **kwargs)
+
+    return run_on_llm_loop(create())
+
+
+class LLMClient:
+    def __init__(
+        self,
+        primary,
+        fallback=None,
+        deadlines: Dict[str, float] | None = None,
+        hedge: bool = True,
+        hedge_quantile: float = 95,
+        stats: LatencyStats | None = None,
+    ):
+        self.primary = primary
+        self.fallback = fallback
+        self.deadlines = {**DEFAULT_DEADLINES, **(deadlines or {})}
+        self.hedge = hedge
+        self.hedge_quantile = hedge_quantile
+        self.stats = stats or LatencyStats()
+
+    def stage(self, name: str) -> "StageLLM":
+        return StageLLM(self, name)
+
+    def hedge_delay(self, stage: str) -> float:
+        deadline = self.deadlines[stage]
+        if self.stats.count(stage) < MIN_SAMPLES:
+            return HEDGE_AT * deadline
+        return min(self.stats.percentile(stage, self.hedge_quantile), deadline)
+
+    def plan(self, stage: str) -> List[Tuple[float, object, str]]:
+        """(seconds after the call, model, label) of each request a call may send."""
+        plan = [(0.0, self.primary, "primary")]
+        if self.hedge:
+            plan.append((self.hedge_delay(stage), self.primary, "hedge"))
+        if self.fallback is not None:
+            plan.append(
+                (FALLBACK_AT * self.deadlines[stage], self.fallback, "fallback")
+            )
+        return sorted(plan, key=lambda step: step[0])
+
+
+class StageLLM(Runnable):
+    """The client's models behind one stage's deadline, usable in `prompt | llm`."""
+
+    def __init__(self, client: LLMClient, stage: str):
+        self.client = client
+        self.stage = stage
+        # results are cached under the primary model (see llm_cache.model_name), the
+        # fallback model's are not cached
+        self.model = (
+            getattr(client.primary, "model", None) or type(client.primary).__name__
+        )
+
+    def _finish(self, start: float, outcome: str, config=None):
+        self.client.stats.record(self.stage, time.perf_counter() - start, outcome)
+        metadata = (config or {}).get("metadata") or {}
+        if OUTCOME_KEY in metadata:
+            metadata[OUTCOME_KEY]["outcome"] = outcome
+
+    def _timeout(self, start: float, deadline: float, config=None) -> TimeoutError:
+        self._finish(start, "timeout", config)
+        return TimeoutError(
+            f"The {self.stage} LLM call missed its {deadline:.0f} s deadline"
+        )
+
+    def invoke(self, input, config=None, **kwargs):
+        return run_on_llm_loop(self._ainvoke(input, config, **kwargs))
+
+    async def ainvoke(self, input, config=None, **kwargs):
+        loop = llm_loop()
+        if asyncio.get_running_loop() is loop:
+            return await self._ainvoke(input, config, **kwargs)
+        # cancelling the wrapping future cancels the call on llm_loop
+        return await asyncio.wrap_future(
+            asyncio.run_coroutine_threadsafe(
+                self._ainvoke(input, config, **kwargs), loop
+            )
+        )
+
+    async def _ainvoke(self, input, config=None, **kwargs):
+        start = time.perf_counter()
+        deadline = self.client.deadlines[self.stage]
+        plan = self.client.plan(self.stage)
+        running = {}
+        error = None
+        try:
+            while True:
+                elapsed = time.perf_counter() - start
+                while plan and (plan[0][0] <= elapsed or not running):
+                    _, llm, label = plan.pop(0)
+                    task = asyncio.create_task(llm.ainvoke(input, config, **kwargs))
+                    running[task] = label
+                next_at = min(plan[0][0], deadline) if plan else deadline
+                done, _ = await asyncio.wait(
+                    running,
+                    timeout=max(next_at - elapsed, 0),
+                    return_when=asyncio.FIRST_COMPLETED,
+                )
+                for task in done:
+                    label = running.pop(task)
+                    if task.exception() is None:
+                        self._finish(start, label, config)
+                        return task.result()
+                    error = task.exception()
+                if not running and not plan:
+                    self._finish(start, "error", config)
+                    raise error
+                if time.perf_counter() - start >= deadline:
+                    raise self._timeout(start, deadline, config)
+        finally:
+            for task in running:
+                task.cancel()
+            await asyncio.gather(*running, return_exceptions=True)
+
+    async def astream(self, input, config=None, **kwargs):
+        """_astream run on llm_loop, its chunks handed over to the calling loop."""
+        caller_loop = asyncio.get_running_loop()
+        if caller_loop is llm_loop():
+            async for chunk in self._astream(input, config, **kwargs):
+                yield chunk
+            return
+        chunks = asyncio.Queue()
+
+        async def pump():
+            try:
+                async for chunk in self._astream(input, config, **kwargs):
+                    caller_loop.call_soon_threadsafe(chunks.put_nowait, (chunk, None))
+            except BaseException as e:
+                caller_loop.call_soon_threadsafe(chunks.put_nowait, (None, e))
+                raise
+            caller_loop.call_soon_threadsafe(chunks.put_nowait, (None, None))
+
+        future = asyncio.run_coroutine_threadsafe(pump(), llm_loop())
+        try:
+            while True:
+                chunk, error = await chunks.get()
+                if error is not None:
+                    raise error
+                if chunk is None:
+                    return
+                yield chunk
+        finally:
+            future.cancel()
+
+    async def _astream(self, input, config=None, **kwargs):
+        """Stream from the primary model, switching to the fallback model if the first
+        chunk has not arrived halfway to the deadline. Only the first chunk is bound by
+        the deadline; streams are not hedged.
+        """
+        start = time.perf_counter()
+        deadline = self.client.deadlines[self.stage]
+        fallback = self.client.fallback
+        label = "primary"
+        stream = self.client.primary.astream(input, config, **kwargs)
+        try:
+            first = await asyncio.wait_for(
+                anext(stream), FALLBACK_AT * deadline if fallback else deadline
+            )
+        except asyncio.TimeoutError:
+            await stream.aclose()
+            if fallback is None:
+                raise self._timeout(start, deadline, config)
+            label = "fallback"
+            stream = fallback.astream(input, config, **kwargs)
+            try:
+                first = await asyncio.wait_for(
+                    anext(stream), deadline - (time.perf_counter() - start)
+                )
+            except asyncio.TimeoutError:
+                await stream.aclose()
+                raise self._timeout(start, deadline, config)
+        # the latency of a stream is the time to its first chunk
+        self._finish(start, label, config)
+        yield first
+        async for chunk in stream:
+            yield chunk
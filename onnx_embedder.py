@@ -0,0 +1,240 @@
+"""ONNX Runtime embedding backend for CPU-only hosts.
+
+OnnxEmbedder runs the same sentence-transformers model as retrieval.Embedder, exported
+once to an ONNX graph and optionally int8 dynamically quantized, through onnxruntime.
+The exported graphs are kept in DEFAULT_ONNX_DIR so the export only happens once per
+model.
+
+Running this module compares the backends on the text of a calendar: a parity check of
+the ONNX embeddings against the PyTorch ones, then single-query latency and batch
+throughput for each backend.
+    python onnx_embedder.py --calendar_path sample_calendar.json --quantize
+"""
+
+import argparse
+import json
+import os
+import statistics
+import time
+from typing import Dict, List
+
+import numpy as np
+
+from retrieval import Embedder, doc_to_text, embedding_dims_dict, model_choice
+
+DEFAULT_ONNX_DIR = ".onnx_cache"
+
+
+def mean_pooling_np(last_hidden_state: np.ndarray, attention_mask: np.ndarray):
+    """numpy version of retrieval.mean_pooling."""
+    mask = attention_mask[..., None].astype(last_hidden_state.dtype)
+    summed = (last_hidden_state * mask).sum(axis=1)
+    counts = np.clip(mask.sum(axis=1), 1e-9, None)
+    return summed / counts
+
+
+def export_onnx(model_name: str, path: str):
+    """Export the transformer of model_name to an ONNX graph at path."""
+    import torch
+    from transformers import AutoTokenizer, AutoModel
+
+    tokenizer = AutoTokenizer.from_pretrained(model_name)
+    model = AutoModel.from_pretrained(model_name).eval()
+    sample = tokenizer(["an example calendar event"], return_tensors="pt")
+    # ONNX inputs follow the order of the forward signature
+    input_names = [
+        name
+        for name in ("input_ids", "attention_mask", "token_type_ids")
+        if name in sample
+    ]
+    dynamic_axes = {name: {0: "batch", 1: "sequence"} for name in input_names}
+    dynamic_axes["last_hidden_state"] = {0: "batch", 1: "sequence"}
+
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with torch.no_grad():
+        torch.onnx.export(
+            model,
+            ({name: sample[name] for name in input_names},),
+            path,
+            input_names=input_names,
+            output_names=["last_hidden_state"],
+            dynamic_axes=dynamic_axes,
+            opset_version=14,
+        )
+
+
+def quantize_onnx(path: str, quantized_path: str):
+    """Write an int8 dynamically quantized copy of the ONNX graph at path."""
+    from onnxruntime.quantization import QuantType, quantize_dynamic
+
+    quantize_dynamic(path, quantized_path, weight_type=QuantType.QInt8)
+
+
+class OnnxEmbedder(Embedder):
+    """Embedder backed by onnxruntime instead of PyTorch, see the module docstring."""
+
+    def __init__(
+        self,
+        model_name: str = model_choice,
+        quantize: bool = False,
+        onnx_dir: str = DEFAULT_ONNX_DIR,
+    ):
+        super().__init__(model_name)
+        self.quantize = quantize
+        self.backend = "onnx-int8" if quantize else "onnx"
+        model_dir = os.path.join(onnx_dir, model_name.replace("/", "__"))
+        self.onnx_path = os.path.join(model_dir, "model.onnx")
+        self.quantized_path = os.path.join(model_dir, "model-int8.onnx")
+        self._input_names = []
+
+    @property
+    def dim(self) -> int:
+        if self.model_name in embedding_dims_dict:
+            return embedding_dims_dict[self.model_name]
+        from transformers import AutoConfig
+
+        return AutoConfig.from_pretrained(self.model_name).hidden_size
+
+    def load(self):
+        """Export (and quantize) the model if needed and open an inference session."""
+        if self.model is not None:
+            return self
+        with self._load_lock:
+            if self.model is None:
+                import onnxruntime as ort
+                from transformers import AutoTokenizer
+
+                if not os.path.exists(self.onnx_path):
+                    export_onnx(self.model_name, self.onnx_path)
+                path = self.onnx_path
+                if self.quantize:
+                    if not os.path.exists(self.quantized_path):
+                        quantize_onnx(self.onnx_path, self.quantized_path)
+                    path = self.quantized_path
+
+                self.tokenizer = AutoTokenizer.from_pretrained(self.model_name)
+                session = ort.InferenceSession(path, providers=["CPUExecutionProvider"])
+                self._input_names = [i.name for i in session.get_inputs()]
+                self.model = session
+        return self
+
+    def _encode(self, texts) -> np.ndarray:
+        self.load()
+        with self._tokenizer_lock:
+            inputs = self.tokenizer(
+                texts, return_tensors="np", padding=True, truncation=True
+            )
+        feed = {name: inputs[name].astype(np.int64) for name in self._input_names}
+        (last_hidden_state,) = self.model.run(["last_hidden_state"], feed)
+        return mean_pooling_np(last_hidden_state, inputs["attention_mask"])
+
+
+def make_embedder(model_name: str = model_choice, backend: str = "torch") -> Embedder:
+    """Return an embedder for backend: 'torch', 'onnx' or 'onnx-int8'."""
+    if backend == "torch":
+        return Embedder(model_name)
+    if backend in ("onnx", "onnx-int8"):
+        return OnnxEmbedder(model_name, quantize=backend == "onnx-int8")
+    raise ValueError(f"Unknown embedder backend: {backend}")
+
+
+def check_parity(reference: Embedder, candidate: Embedder, texts: List[str]) -> Dict:
+    """Compare candidate embeddings with reference ones on texts.
+    Reports the cosine similarity of each pair of rows and the largest absolute
+    difference of any component.
+    """
+    expected = reference.embed_batch(texts)
+    actual = candidate.embed_batch(texts)
+    cosine = (expected * actual).sum(axis=1) / (
+        np.linalg.norm(expected, axis=1) * np.linalg.norm(actual, axis=1)
+    )
+    return {
+        "min_cosine": float(cosine.min()),
+        "mean_cosine": float(cosine.mean()),
+        "max_abs_diff": float(np.abs(expected - actual).max()),
+    }
+
+
+def benchmark_embedder(
+    embedder: Embedder, texts: List[str], batch_size: int = 32, n_queries: int = 50
+) -> Dict:
+    """Single-query latency (as for a user question) and batch throughput (as for an
+    index build) of embedder on texts.
+    """
+    embedder.load()
+    embedder.embed(texts[0])  # warm up
+
+    latencies = []
+    for i in range(n_queries):
+        start_time = time.perf_counter()
+        embedder.embed(texts[i % len(texts)])
+        latencies.append(time.perf_counter() - start_time)
+    latencies.sort()
+
+    start_time = time.perf_counter()
+    embedder.embed_batch(texts, batch_size=batch_size)
+    elapsed = time.perf_counter() - start_time
+
+    return {
+        "p50_ms": 1000 * statistics.median(latencies),
+        "p95_ms": 1000 * latencies[int(0.95 * (len(latencies) - 1))],
+        "docs_per_sec": len(texts) / elapsed,
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Compare the PyTorch and ONNX Runtime embedding backends."
+    )
+    parser.add_argument(
+        "-p",
+        "--calendar_path",
+        default="sample_calendar.json",
+        type=str,
+        help="Calendar whose events are embedded. Default is 'sample_calendar.json'.",
+    )
+    parser.add_argument(
+        "-f",
+        "--fields",
+        default=["location", "summary", "description"],
+        type=lambda fields: [field.strip() for field in fields.split(",")],
+        help="Comma separated text fields in calendar to embed.",
+    )
+    parser.add_argument(
+        "-m", "--model", default=model_choice, type=str, help="Embedding model name."
+    )
+    parser.add_argument(
+        "-q",
+        "--quantize",
+        action="store_true",
+        help="Also check and benchmark the int8 quantized ONNX graph.",
+    )
+    parser.add_argument(
+        "-b", "--batch_size", default=32, type=int, help="Batch size for throughput."
+    )
+    args = parser.parse_args()
+
+    calendar = json.load(open(args.calendar_path))
+    texts = [doc_to_text(doc, args.fields) for doc in calendar]
+    print(f"{len(texts)} events in calendar")
+
+    backends = ["torch", "onnx"] + (["onnx-int8"] if args.quantize else [])
+    embedders = {backend: make_embedder(args.model, backend) for backend in backends}
+
+    for backend in backends[1:]:
+        parity = check_parity(embedders["torch"], embedders[backend], texts)
+        print(
+            f"Parity {backend} vs torch: min cosine {parity['min_cosine']:.5f}, "
+            f"mean cosine {parity['mean_cosine']:.5f}, "
+            f"max abs diff {parity['max_abs_diff']:.2e}"
+        )
+
+    for backend in backends:
+        result = benchmark_embedder(
+            embedders[backend], texts, batch_size=args.batch_size
+        )
+        print(
+            f"{backend:>10}: query p50 {result['p50_ms']:.1f} ms, "
+            f"p95 {result['p95_ms']:.1f} ms, "
+            f"{result['docs_per_sec']:.1f} docs/sec (batch_size={args.batch_size})"
+        )
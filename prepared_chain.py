@@ -0,0 +1,60 @@
+"""LLM chains built once and reused for every turn.
+
+A PreparedChain renders its parser's format instructions into the prompt template once,
+composes `prompt | llm | parser` once and computes the prompt_version used by the LLM
+result cache once, instead of on every classify_intent / extract_dates call. Its
+invoke/ainvoke retry a failed call once, tolerating replies wrapped in markdown code
+fences (which the parsers reject), before giving up. Calls that missed their deadline
+(see llm_client) are not retried.
+"""
+
+import re
+
+from langchain_core.prompts import PromptTemplate
+
+from llm_cache import model_name, prompt_version
+
+CODE_FENCE_PATTERN = re.compile(r"^\s*```[a-zA-Z]*\s*|\s*```\s*$")
+
+
+def strip_code_fences(text: str) -> str:
+    return CODE_FENCE_PATTERN.sub("", text)
+
+
+class PreparedChain:
+    def __init__(self, template: str, input_variables, parser, llm):
+        self.template = template
+        self.parser = parser
+        self.llm = llm
+        self.format_instructions = parser.get_format_instructions()
+        self.prompt = PromptTemplate(
+            template=template,
+            input_variables=list(input_variables),
+            partial_variables={"format_instructions": self.format_instructions},
+        )
+        self.chain = self.prompt | llm | parser
+        # for the retry, which parses the raw reply itself
+        self.raw_chain = self.prompt | llm
+        self.version = prompt_version(template, self.format_instructions)
+        self.model = model_name(llm)
+
+    def _parse_reply(self, reply):
+        return self.parser.parse(strip_code_fences(getattr(reply, "content", reply)))
+
+    def invoke(self, inputs, config=None):
+        try:
+            return self.chain.invoke(inputs, config)
+        except TimeoutError:
+            # the deadline is spent, retrying would only miss it again
+            raise
+        except Exception:
+            return self._parse_reply(self.raw_chain.invoke(inputs, config))
+
+    async def ainvoke(self, inputs, config=None):
+        try:
+            return await self.chain.ainvoke(inputs, config)
+        except TimeoutError:
+            # the deadline is spent, retrying would only miss it again
+            raise
+        except Exception:
+            return self._parse_reply(await self.raw_chain.ainvoke(inputs, config))
@@ -0,0 +1,74 @@
+"""Bounded LRU caches for per-question work.
+
+Follow-up questions and repeated phrasings ("What's happening today?") would otherwise
+embed the same question and run the same retrieval again. retrieval keeps two caches:
+    - query embeddings, keyed by the normalized question and the embedder's cache_name,
+    - retrieve_docs results, keyed by the normalized question, the extracted dates,
+      top_n and a calendar version, so a changed calendar or index never hits entries
+      made for the old one.
+Both count hits and misses, see LRUCache.stats.
+"""
+
+import threading
+from collections import OrderedDict
+from typing import Dict, Hashable
+
+
+def normalize_query(query: str) -> str:
+    """Lower case the query and collapse its whitespace."""
+    return " ".join(query.lower().split())
+
+
+class LRUCache:
+    """Thread-safe mapping holding at most maxsize entries, evicting the least
+    recently used one. maxsize=0 disables the cache.
+    """
+
+    def __init__(self, maxsize: int = 256):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def get(self, key: Hashable, default=None):
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return self._entries[key]
+            self.misses += 1
+            return default
+
+    def put(self, key: Hashable, value):
+        if self.maxsize <= 0:
+            return
+        with self._lock:
+            self._entries[key] = value
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        """Drop every entry, e.g. when the calendar or index changes."""
+        with self._lock:
+            self._entries.clear()
+
+    def resize(self, maxsize: int):
+        with self._lock:
+            self.maxsize = maxsize
+            while len(self._entries) > max(maxsize, 0):
+                self._entries.popitem(last=False)
+
+    def stats(self) -> Dict:
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "size": len(self._entries),
+            "maxsize": self.maxsize,
+        }
@@ -0,0 +1,224 @@
+import asyncio
+import os
+from datetime import date
+from typing import List, Literal
+
+from dotenv import load_dotenv
+from langchain_google_genai import ChatGoogleGenerativeAI
+from langchain_core.output_parsers import JsonOutputParser, PydanticOutputParser
+
+from pydantic import BaseModel, Field
+
+from date_rules import resolve_dates
+from intent_classifier import guess_locally, intent_stats, local_classifier
+from date_extraction import resolver_stats
+from llm_cache import LLMResultCache, acached_invoke, cached_invoke
+from prepared_chain import PreparedChain
+
+load_dotenv()
+
+# One prompt for both intent classification and date extraction, so a calendar question
+# needs a single LLM call (and a single few-shot prompt) before retrieval instead of
+# classify_intent followed by extract_dates.
+QUERY_UNDERSTANDING_PROMPT = """
+### Task Instructions
+
+Given today's date of {date}, classify the user query into an intent and extract the dates it refers to.
+
+**INTENTS**:
+- "ask_date": The user is asking for the current date.
+- "calendar_qa": The user inquires about events on their calendar. For example, when an event is taking place, or where an event is happening.
+- "out_of_scope": The query does not pertain to asking for the date or inquiring about calendar events.
+
+**DATES**:
+1. Determine the exact date or date range the query refers to based on its context. For date ranges, include every day covered.
+2. If the query refers to a recurring event (e.g., "Remind me every Tuesday"), return the four nearest upcoming dates starting from today.
+3. Format each date as "Month DD, YYYY".
+4. If the query does not reference any specific dates, or the intent is not "calendar_qa", return an empty list.
+
+### Examples
+
+query = "What is today's date?", Date = "Friday, May 24, 2024"
+output: {{"intent": "ask_date", "extracted_dates": []}}
+
+query = "Schedule for this weekend", Date = "Friday, May 24, 2024"
+output: {{"intent": "calendar_qa", "extracted_dates": ["May 25, 2024", "May 26, 2024"]}}
+
+query = "When do I have meetings this week?", Date = "Monday, May 27, 2024"
+output: {{"intent": "calendar_qa", "extracted_dates": ["May 27, 2024", "May 28, 2024", "May 29, 2024", "May 30, 2024", "May 31, 2024", "June 1, 2024", "June 2, 2024"]}}
+
+query = "What is my schedule next Tuesday?", Date = "Monday, May 27, 2024"
+output: {{"intent": "calendar_qa", "extracted_dates": ["May 28, 2024"]}}
+
+query = "Where is my Conversational AI class?", Date = "Monday, May 27, 2024"
+output: {{"intent": "calendar_qa", "extracted_dates": []}}
+
+query = "How do you cook a steak?", Date = "Monday, May 27, 2024"
+output: {{"intent": "out_of_scope", "extracted_dates": []}}
+
+{format_instructions}
+
+query = {query}
+"""
+
+
+class QueryUnderstanding(BaseModel):
+    intent: Literal["ask_date", "calendar_qa", "out_of_scope"] = Field(
+        description="Classifies the user's query into 'ask_date' for queries asking about the current date, 'calendar_qa' for queries inquiring about calendar events, or 'out_of_scope' for queries that do not fit the other categories."
+    )
+    extracted_dates: List[str] = Field(
+        description="List of extracted dates in 'Month DD, YYYY' format"
+    )
+
+
+query_understanding_parser = PydanticOutputParser(pydantic_object=QueryUnderstanding)
+
+
+def understand_locally(
+    query: str, formatted_date: str, verbose: bool = False, use_rules: bool = True
+) -> QueryUnderstanding | None:
+    """Intent and dates from the local classifier and date rules, None unless both
+    are confident. Without use_rules only intents that need no dates (all but
+    calendar_qa) are answered locally.
+    """
+    intent, confidence = local_classifier.predict(query)
+    if confidence < local_classifier.threshold:
+        intent_stats.record(False)
+        return None
+    extracted_dates = []
+    if intent == "calendar_qa":
+        extracted_dates = resolve_dates(query, formatted_date) if use_rules else None
+        if use_rules:
+            resolver_stats.record(extracted_dates is not None)
+        if extracted_dates is None:
+            # the LLM is called for the dates and classifies the intent as well
+            intent_stats.record(False)
+            return None
+    intent_stats.record(True)
+    response = QueryUnderstanding(intent=intent, extracted_dates=extracted_dates)
+    if verbose:
+        print(
+            f"Query: '{query}' \n -> Intent (local): {response.intent}, Dates: {response.extracted_dates}"
+        )
+    return response
+
+
+def guess_understanding(
+    query: str, formatted_date: str, verbose: bool = False
+) -> QueryUnderstanding:
+    """The local classifier's guess and the dates rules resolve, for when the LLM
+    missed its deadline.
+    """
+    intent = guess_locally(query, verbose).intent
+    extracted_dates = resolve_dates(query, formatted_date) or []
+    return QueryUnderstanding(
+        intent=intent,
+        extracted_dates=extracted_dates if intent == "calendar_qa" else [],
+    )
+
+
+def query_understanding_chain(
+    llm: ChatGoogleGenerativeAI,
+    parser: JsonOutputParser | PydanticOutputParser = query_understanding_parser,
+) -> PreparedChain:
+    """The fused chain, to build once and pass to understand_query."""
+    return PreparedChain(QUERY_UNDERSTANDING_PROMPT, ["date", "query"], parser, llm)
+
+
+def understand_query(
+    query: str,
+    llm: ChatGoogleGenerativeAI,
+    formatted_date: str,
+    parser: JsonOutputParser | PydanticOutputParser = query_understanding_parser,
+    verbose: bool = False,
+    use_local_intent: bool = True,
+    use_date_rules: bool = True,
+    cache: LLMResultCache | None = None,
+    prepared: PreparedChain | None = None,
+) -> QueryUnderstanding:
+    """Classify the intent of query and extract its dates with one LLM call.
+    With use_local_intent the local intent classifier, and with use_date_rules the
+    date rules, are tried first, and the LLM is skipped when they are confident about
+    both (see understand_locally). With a cache, LLM answers are looked up in and
+    saved to it. prepared is the chain from query_understanding_chain, built here if
+    not given.
+    """
+    if use_local_intent:
+        response = understand_locally(query, formatted_date, verbose, use_date_rules)
+        if response is not None:
+            return response
+    prepared = prepared or query_understanding_chain(llm, parser)
+    try:
+        response = cached_invoke(
+            cache,
+            "fused",
+            query,
+            formatted_date,
+            prepared,
+            {"date": formatted_date, "query": query},
+        )
+    except TimeoutError as e:
+        print(f"{e}, using the local classifier and date rules")
+        return guess_understanding(query, formatted_date, verbose)
+    if verbose:
+        print(
+            f"Query: '{query}' \n -> Intent: {response.intent}, Dates: {response.extracted_dates}"
+        )
+    return response
+
+
+async def aunderstand_query(
+    query: str,
+    llm: ChatGoogleGenerativeAI,
+    formatted_date: str,
+    parser: JsonOutputParser | PydanticOutputParser = query_understanding_parser,
+    verbose: bool = False,
+    use_local_intent: bool = True,
+    use_date_rules: bool = True,
+    cache: LLMResultCache | None = None,
+    prepared: PreparedChain | None = None,
+) -> QueryUnderstanding:
+    """understand_query with the local step in a worker thread and ainvoke."""
+    if use_local_intent:
+        response = await asyncio.to_thread(
+            understand_locally, query, formatted_date, verbose, use_date_rules
+        )
+        if response is not None:
+            return response
+    prepared = prepared or query_understanding_chain(llm, parser)
+    try:
+        response = await acached_invoke(
+            cache,
+            "fused",
+            query,
+            formatted_date,
+            prepared,
+            {"date": formatted_date, "query": query},
+        )
+    except TimeoutError as e:
+        print(f"{e}, using the local classifier and date rules")
+        return await asyncio.to_thread(
+            guess_understanding, query, formatted_date, verbose
+        )
+    if verbose:
+        print(
+            f"Query: '{query}' \n -> Intent: {response.intent}, Dates: {response.extracted_dates}"
+        )
+    return response
+
+
+if __name__ == "__main__":
+    from intent_classifier import TEST_QUERIES
+
+    gemini_llm = ChatGoogleGenerativeAI(
+        api_key=os.getenv("GOOGLE_API_KEY"), model="gemini-1.5-pro-latest"
+    )
+    formatted_date = date.today().strftime("%A, %B %d, %Y")
+
+    n_correct = 0
+    for query, intent in TEST_QUERIES:
+        response = understand_query(
+            query, gemini_llm, formatted_date, verbose=True, use_local_intent=False
+        )
+        n_correct += response.intent == intent
+    print(f"Intent accuracy: {n_correct}/{len(TEST_QUERIES)}")
@@ -3,26 +3,25 @@ from datetime import date, datetime
 import time
 import argparse
 import json
-from typing import List, Dict
-import torch
-from transformers import AutoTokenizer, AutoModel
-from annoy import AnnoyIndex
-from langchain_google_genai import ChatGoogleGenerativeAI
-
+import threading
+from typing import List, Dict, Tuple
+import numpy as np
 
 from dotenv import load_dotenv
 
-from date_extraction import extract_dates
+from date_index import DateIndex
+from embedding_batcher import EmbeddingBatcher
+from lexical_index import BM25Index, reciprocal_rank_fusion
+from query_cache import LRUCache, normalize_query
 
 load_dotenv()
 
-# Initialize tokenizer and model
+# torch, transformers and annoy are imported on first use, so importing this module
+# (e.g. for format_doc_date or `python bot.py --help`) does not load the model.
+
 # MODEL = "sentence-transformers/msmarco-bert-base-dot-v5"
 model_choice = "sentence-transformers/all-MiniLM-L6-v2"
 
-tokenizer = AutoTokenizer.from_pretrained(model_choice)
-model = AutoModel.from_pretrained(model_choice)
-
 embedding_dims_dict = {
     "sentence-transformers/all-MiniLM-L6-v2": 384,
     "sentence-transformers/msmarco-bert-base-dot-v5": 768,
@@ -31,23 +30,183 @@ embedding_dims_dict = {
 embedding_dims = embedding_dims_dict[model_choice]
 
 
+def mean_pooling(last_hidden_state, attention_mask):
+    """Average token embeddings, ignoring padding positions."""
+    mask = attention_mask.unsqueeze(-1).type_as(last_hidden_state)
+    summed = (last_hidden_state * mask).sum(dim=1)
+    counts = mask.sum(dim=1).clamp(min=1e-9)
+    return summed / counts
+
+
+class Embedder:
+    """Sentence embedding model whose tokenizer and weights are loaded on first use."""
+
+    backend = "torch"
+
+    def __init__(self, model_name: str = model_choice):
+        self.model_name = model_name
+        self.tokenizer = None
+        self.model = None
+        self._load_lock = threading.Lock()
+        # fast tokenizers are not safe to call from several threads at once
+        self._tokenizer_lock = threading.Lock()
+
+    @property
+    def loaded(self) -> bool:
+        return self.model is not None
+
+    @property
+    def cache_name(self) -> str:
+        """Name to key cached embeddings by, backends other than torch differ slightly."""
+        if self.backend == "torch":
+            return self.model_name
+        return f"{self.model_name}@{self.backend}"
+
+    @property
+    def dim(self) -> int:
+        if self.model_name in embedding_dims_dict:
+            return embedding_dims_dict[self.model_name]
+        return self.load().model.config.hidden_size
+
+    def load(self):
+        """Load the tokenizer and model if they are not loaded yet, returns self."""
+        if self.model is not None:
+            return self
+        with self._load_lock:
+            if self.model is None:
+                from transformers import AutoTokenizer, AutoModel
+
+                self.tokenizer = AutoTokenizer.from_pretrained(self.model_name)
+                self.model = AutoModel.from_pretrained(self.model_name)
+        return self
+
+    def load_in_background(self) -> threading.Thread:
+        """Start loading the model in a daemon thread, e.g. while waiting for input."""
+        thread = threading.Thread(target=self.load, daemon=True)
+        thread.start()
+        return thread
+
+    def _encode(self, texts) -> np.ndarray:
+        import torch
+
+        self.load()
+        with self._tokenizer_lock:
+            inputs = self.tokenizer(
+                texts, return_tensors="pt", padding=True, truncation=True
+            )
+        with torch.no_grad():
+            outputs = self.model(**inputs)
+        return mean_pooling(outputs.last_hidden_state, inputs["attention_mask"]).numpy()
+
+    def embed(self, text: str) -> np.ndarray:
+        return self._encode(text).squeeze()
+
+    def embed_batch(
+        self, texts: List[str], batch_size: int = 32, verbose: bool = False
+    ) -> np.ndarray:
+        """Embed texts in batches of batch_size, returns an array of shape (len(texts), dim).
+        Texts are sorted by length before batching so each batch pads to a similar length,
+        and the output rows are returned in the original order.
+        """
+        start_time = time.time()
+        embeddings = np.zeros((len(texts), self.dim), dtype=np.float32)
+        order = sorted(range(len(texts)), key=lambda i: len(texts[i]))
+        for start in range(0, len(order), batch_size):
+            batch_ids = order[start : start + batch_size]
+            embeddings[batch_ids] = self._encode([texts[i] for i in batch_ids])
+
+        if verbose:
+            elapsed = time.time() - start_time
+            print(
+                f"Embedded {len(texts)} docs in {elapsed:.2f} seconds "
+                f"({len(texts) / max(elapsed, 1e-9):.1f} docs/sec, batch_size={batch_size})"
+            )
+        return embeddings
+
+
+embedder = Embedder(model_choice)
+
+# query embeddings by (normalized query, embedder.cache_name)
+query_embedding_cache = LRUCache(maxsize=1024)
+# retrieve_docs results, see retrieve_docs
+retrieval_cache = LRUCache(maxsize=256)
+
+
+# with concurrent queries, an EmbeddingBatcher around embedder, see set_query_batcher
+query_batcher = None
+
+
+def set_embedder(new_embedder: Embedder):
+    """Replace the embedder used by get_embeddings and get_batch_embeddings."""
+    global embedder
+    embedder = new_embedder
+
+
+def set_query_batcher(batcher: EmbeddingBatcher | None):
+    """Embed the queries of get_embeddings through batcher (built around the current
+    embedder), so concurrent queries share forward passes. None embeds them one by one.
+    """
+    global query_batcher
+    query_batcher = batcher
+
+
 def get_embeddings(text):
-    inputs = tokenizer(text, return_tensors="pt", padding=True, truncation=True)
-    with torch.no_grad():
-        outputs = model(**inputs)
-    embeddings = outputs.last_hidden_state.mean(dim=1)
-    return embeddings.squeeze().numpy()
+    key = (normalize_query(text), embedder.cache_name)
+    embedding = query_embedding_cache.get(key)
+    if embedding is None:
+        if query_batcher is not None:
+            embedding = np.asarray(query_batcher.embed(text))
+        else:
+            embedding = np.asarray(embedder.embed(text))
+        embedding.setflags(write=False)  # shared by every later hit
+        query_embedding_cache.put(key, embedding)
+    return embedding
+
+
+def get_batch_embeddings(
+    texts: List[str], batch_size: int = 32, verbose: bool = False
+) -> np.ndarray:
+    return embedder.embed_batch(texts, batch_size=batch_size, verbose=verbose)
+
+
+def doc_to_text(doc: Dict, text_fields: List[str]) -> str:
+    return " ".join([str(doc.get(field, "")) for field in text_fields])
+
+
+def embed_docs(
+    docs, text_fields: List[str], batch_size: int = 32, verbose: bool = False
+) -> np.ndarray:
+    """Embed the text_fields of each doc, row i of the result belongs to docs[i]."""
+    doc_texts = [doc_to_text(doc, text_fields) for doc in docs]
+    return get_batch_embeddings(doc_texts, batch_size=batch_size, verbose=verbose)
+
+
+def build_annoy_index_from_embeddings(embeddings: np.ndarray, n_trees: int = 10):
+    """Build an angular Annoy index where item i is row i of embeddings."""
+    from annoy import AnnoyIndex
+
+    index = AnnoyIndex(embeddings.shape[1], "angular")
+    for i, embedding in enumerate(embeddings):
+        index.add_item(i, embedding)
+    index.build(n_trees)
+    return index
 
 
 def build_annoy_index(
-    docs, text_fields: List[str], embedding_dim: int = embedding_dims, n_trees: int = 10
+    docs,
+    text_fields: List[str],
+    embedding_dim: int = embedding_dims,
+    n_trees: int = 10,
+    batch_size: int = 32,
+    verbose: bool = False,
 ):
+    from annoy import AnnoyIndex
+
     # start_time = time.time()  # Start timing
     index = AnnoyIndex(embedding_dim, "angular")
-    for i, doc in enumerate(docs):
-        doc_text = " ".join([str(doc.get(field, "")) for field in text_fields])
-        embedding = get_embeddings(doc_text)
-        index.add_item(doc["index_id"], embedding)  # Use index i as the item ID
+    embeddings = embed_docs(docs, text_fields, batch_size=batch_size, verbose=verbose)
+    for doc, embedding in zip(docs, embeddings):
+        index.add_item(doc["index_id"], embedding)
     index.build(n_trees)
     # print(
     #     f"Annoy index built in {time.time() - start_time} seconds"
@@ -75,52 +234,184 @@ def format_doc_date(doc_date):
         return None
 
 
-def retrieve_with_dates(docs, extracted_dates):
-    for doc in docs:
-        doc_date = format_doc_date(doc.get("date", ""))
-        date_score = 1 if doc_date in extracted_dates else 0
-        doc["date_score"] = date_score
-    return [doc for doc in docs if doc["date_score"] > 0]
+def retrieve_with_dates(docs, extracted_dates, date_index=None) -> List[int]:
+    """Return the index_ids of docs whose date is one of extracted_dates.
+    With a DateIndex built at load time this is a lookup, otherwise every doc is parsed.
+    """
+    if date_index is not None:
+        return date_index.lookup(extracted_dates)
+    return [
+        doc["index_id"]
+        for doc in docs
+        if format_doc_date(doc.get("date", "")) in extracted_dates
+    ]
 
 
-def retrieve_with_sbert(query, docs, index, top_n=5, exclude_ids=set()):
+def retrieve_with_sbert(
+    query, docs, index, top_n=5, exclude_ids=frozenset()
+) -> List[Tuple[int, float]]:
+    """Return (index_id, sbert_score) for the top_n docs closest to the query that are
+    not in exclude_ids, best first. Lower scores are closer (Annoy angular distance).
+    Only top_n neighbours are requested from the index at first, the request is widened
+    only if excluded docs leave fewer than top_n results.
+    """
+    if top_n <= 0:
+        return []
     query_embedding = get_embeddings(query)
-    nearest_ids, scores = index.get_nns_by_vector(
-        query_embedding, len(docs), include_distances=True
-    )  # Query all documents
 
-    # Assign scores to all documents immediately
-    for doc_id, score in zip(nearest_ids, scores):
-        docs[doc_id]["sbert_score"] = score
-
-    # Filter out excluded documents and select the top scoring ones
-    scored_docs = [docs[i] for i in nearest_ids if docs[i]["id"] not in exclude_ids]
+    n_candidates = min(top_n, len(docs))
+    while True:
+        nearest_ids, scores = index.get_nns_by_vector(
+            query_embedding, n_candidates, include_distances=True
+        )
+        candidates = [
+            (doc_id, score)
+            for doc_id, score in zip(nearest_ids, scores)
+            if docs[doc_id]["id"] not in exclude_ids
+        ]
+        if len(candidates) >= top_n or n_candidates >= len(docs):
+            break
+        # enough room for every excluded doc, doubling if the index still comes up short
+        n_candidates = min(max(2 * n_candidates, top_n + len(exclude_ids)), len(docs))
 
     # Sort by SBERT score to get the best results
-    scored_docs.sort(key=lambda doc: doc["sbert_score"])
-
-    return scored_docs[:top_n]  # Return only top_n results
-
+    candidates.sort(key=lambda candidate: candidate[1])
+
+    return candidates[:top_n]  # Return only top_n results
+
+
+def rank_with_sbert(query, candidate_ids, index, top_n=5) -> List[Tuple[int, float]]:
+    """Return (index_id, sbert_score) for the top_n of candidate_ids closest to the
+    query, best first. Only the candidates' embedding rows are scored, exactly, so the
+    cost follows the number of candidates rather than the size of the calendar.
+    """
+    if top_n <= 0 or not candidate_ids:
+        return []
+    query_embedding = np.asarray(get_embeddings(query), dtype=np.float32)
+    candidate_ids = np.asarray(candidate_ids, dtype=np.int64)
+    distances = np.asarray(index.distances(query_embedding, candidate_ids))
+    if top_n < len(distances):
+        best = np.argpartition(distances, top_n - 1)[:top_n]
+    else:
+        best = np.arange(len(distances))
+    best = best[np.argsort(distances[best], kind="stable")]
+    return [(int(candidate_ids[i]), float(distances[i])) for i in best]
+
+
+def retrieve_docs(
+    query,
+    extracted_dates,
+    docs,
+    index,
+    top_n=3,
+    date_index=None,
+    lexical_index=None,
+    lexical_mode="fuse",
+    filter_by_dates=False,
+    calendar_version=None,
+):
+    """Retrieve docs matching the extracted dates, topped up with SBERT results.
+    With filter_by_dates the docs in the date window are candidates rather than
+    results: only their embeddings are ranked against the query and the top_n kept.
+    With a lexical_index (BM25Index) the top up is the reciprocal-rank fusion of the
+    SBERT and BM25 rankings, and with lexical_mode="fast" a confident lexical match is
+    used on its own, without embedding the query.
+    docs is only read: scores are attached to per-query copies of the returned docs,
+    so one loaded calendar can serve concurrent queries.
+    With a calendar_version (anything that changes when docs or index change) results
+    are cached in retrieval_cache.
+    """
+    if calendar_version is not None:
+        result_key = (
+            normalize_query(query),
+            tuple(extracted_dates),
+            top_n,
+            calendar_version,
+            lexical_mode if lexical_index is not None else None,
+            filter_by_dates,
+        )
+        cached = retrieval_cache.get(result_key)
+        if cached is not None:
+            return {
+                **cached,
+                "query": query,
+                "relevant_docs": list(cached["relevant_docs"]),
+            }
 
-def retrieve_docs(query, extracted_dates, docs, index, top_n=3):
     # start_time = time.time()  # Start timing
-    # Assign SBERT scores to all documents
-    all_docs_scored = retrieve_with_sbert(query, docs, index, top_n=len(docs))
-
     # Retrieve documents based on date matching
-    date_retrieved_docs = retrieve_with_dates(docs, extracted_dates)
+    date_retrieved_ids = retrieve_with_dates(docs, extracted_dates, date_index)
+    if filter_by_dates and date_retrieved_ids:
+        ranked = rank_with_sbert(query, date_retrieved_ids, index, top_n=top_n)
+        date_retrieved_ids = [doc_id for doc_id, _ in ranked]
+        date_retrieved_docs = [
+            {**docs[doc_id], "date_score": 1, "sbert_score": score}
+            for doc_id, score in ranked
+        ]
+    else:
+        date_retrieved_docs = [
+            {**docs[doc_id], "date_score": 1} for doc_id in date_retrieved_ids
+        ]
 
     date_retrieved_doc_ids = {doc["id"] for doc in date_retrieved_docs}
 
-    # Filter SBERT scored docs excluding the date-retrieved ones to avoid duplication
+    # Fill the remaining slots with SBERT results, excluding the date-retrieved docs to avoid duplication
     additional_docs_needed = max(0, top_n - len(date_retrieved_docs))
 
-    additional_sbert_docs = [
-        doc for doc in all_docs_scored if doc["id"] not in date_retrieved_doc_ids
-    ][:additional_docs_needed]
-
-    # Combine date-retrieved docs with additional SBERT docs
-    combined_docs = date_retrieved_docs + additional_sbert_docs
+    if lexical_index is None or additional_docs_needed == 0:
+        retrieval_mode = "sbert"
+        sbert_results = retrieve_with_sbert(
+            query,
+            docs,
+            index,
+            top_n=additional_docs_needed,
+            exclude_ids=date_retrieved_doc_ids,
+        )
+        additional_docs = [
+            {**docs[doc_id], "sbert_score": score} for doc_id, score in sbert_results
+        ]
+    else:
+        # rank deeper than needed so fusion can promote docs found by both
+        depth = max(2 * additional_docs_needed, 10)
+        lexical_results, matched_terms = lexical_index.search(
+            query, depth, exclude_ids=set(date_retrieved_ids)
+        )
+        bm25_scores = dict(lexical_results)
+        if lexical_mode == "fast" and lexical_index.is_confident(
+            query, lexical_results, matched_terms
+        ):
+            retrieval_mode = "lexical"
+            additional_docs = [
+                {**docs[doc_id], "bm25_score": score}
+                for doc_id, score in lexical_results[:additional_docs_needed]
+            ]
+        else:
+            retrieval_mode = "hybrid"
+            sbert_results = retrieve_with_sbert(
+                query,
+                docs,
+                index,
+                top_n=depth,
+                exclude_ids=date_retrieved_doc_ids,
+            )
+            sbert_scores = dict(sbert_results)
+            fused = reciprocal_rank_fusion(
+                [
+                    [doc_id for doc_id, _ in sbert_results],
+                    [doc_id for doc_id, _ in lexical_results],
+                ]
+            )
+            additional_docs = []
+            for doc_id, rrf_score in fused[:additional_docs_needed]:
+                doc = {**docs[doc_id], "rrf_score": rrf_score}
+                if doc_id in sbert_scores:
+                    doc["sbert_score"] = sbert_scores[doc_id]
+                if doc_id in bm25_scores:
+                    doc["bm25_score"] = bm25_scores[doc_id]
+                additional_docs.append(doc)
+
+    # Combine date-retrieved docs with the additional docs
+    combined_docs = date_retrieved_docs + additional_docs
 
     # print(
     #     f"Retrieval for '{query}' completed in {time.time() - start_time} seconds"
@@ -131,11 +422,18 @@ def retrieve_docs(query, extracted_dates, docs, index, top_n=3):
         "top_n": top_n,
         "relevant_docs": combined_docs,  # Ensure we return exactly top_n docs
         "extracted_dates": extracted_dates,
+        "retrieval_mode": retrieval_mode,
     }
+    if calendar_version is not None:
+        retrieval_cache.put(result_key, response)
+        response = {**response, "relevant_docs": list(combined_docs)}
     return response
 
 
 if __name__ == "__main__":
+    from langchain_google_genai import ChatGoogleGenerativeAI
+
+    from date_extraction import extract_dates
 
     # Setup the argument parser
     # Setup the argument parser
@@ -155,13 +453,7 @@ if __name__ == "__main__":
         else "sentence-transformers/msmarco-bert-base-dot-v5"
     )
 
-    embedding_dims_dict = {
-        "sentence-transformers/all-MiniLM-L6-v2": 384,
-        "sentence-transformers/msmarco-bert-base-dot-v5": 768,
-    }
-
-    tokenizer = AutoTokenizer.from_pretrained(model_choice)
-    model = AutoModel.from_pretrained(model_choice)
+    embedder = Embedder(model_choice)
 
     calendar = json.load(open("my_calendar_data_filtered.json"))
     print(f"{len(calendar)} events in calendar")
@@ -176,7 +468,10 @@ if __name__ == "__main__":
         docs=calendar,
         text_fields=text_fields,
         embedding_dim=embedding_dims_dict[model_choice],
+        verbose=True,
     )
+    date_index = DateIndex(calendar, verbose=True)
+    lexical_index = BM25Index(calendar, text_fields)
 
     # # Example cases
     queries = [
@@ -223,6 +518,8 @@ if __name__ == "__main__":
             extracted_dates=extracted_dates.get("extracted_dates", []),
             index=annoy_index,
             top_n=top_n,
+            date_index=date_index,
+            lexical_index=lexical_index,
         )
         print(
             f"Query: '{query}' -&gt; Relevant Docs: {len(response.get('relevant_docs', []))}"
@@ -0,0 +1,321 @@
+"""Serve the calendar bot to many users from one process.
+
+The calendar, embedding model, vector and BM25 indexes, LLM client and caches are
+loaded once (bot.load_bot) and shared by every session; a session only holds its chat
+history, itself bounded by --history_tokens. Sessions idle for longer than
+--session_ttl are dropped and at most --max_sessions are kept (the least recently used
+go first), and at most --max_concurrent_turns questions are answered at a time, so
+memory stays bounded however many users connect.
+
+    python server.py --calendar_path sample_calendar.json --port 8080
+
+Endpoints:
+    POST /chat      {"question": ..., "session_id": ...} streams the answer as text;
+                    the session id (new if none was given) is in X-Session-Id
+    GET  /ws        WebSocket, send {"question": ...}, receive {"type": "chunk",
+                    "text": ...} messages then {"type": "done", "response": ...}
+    DELETE /sessions/{session_id}
+    GET  /health    sessions, per-stage LLM latencies and query embedding batches
+"""
+
+import asyncio
+import time
+import uuid
+from collections import OrderedDict
+from contextlib import contextmanager
+from typing import Dict, Set
+
+from aiohttp import WSMsgType, web
+
+import retrieval
+from bot import answer_question, build_arg_parser, load_bot
+from chat_history import ChatHistory
+from timing import StartupTimer
+
+SETTINGS = web.AppKey("settings", dict)
+TURNS = web.AppKey("turns", asyncio.Semaphore)
+
+
+class Session:
+    def __init__(self, session_id: str, chat_history: ChatHistory):
+        self.session_id = session_id
+        self.chat_history = chat_history
+        # one question at a time per session, turns build on each other
+        self.lock = asyncio.Lock()
+        self.last_used = time.monotonic()
+        # open requests and sockets using the session, which is not evicted meanwhile
+        self.users = 0
+
+
+class SessionStore:
+    """Sessions by id, at most max_sessions and none idle for longer than ttl_seconds."""
+
+    def __init__(
+        self,
+        make_history,
+        max_sessions: int = 1000,
+        ttl_seconds: float = 3600,
+    ):
+        self.make_history = make_history
+        self.max_sessions = max_sessions
+        self.ttl_seconds = ttl_seconds
+        self.sessions: OrderedDict[str, Session] = OrderedDict()
+        # chat histories of dropped sessions being closed, referenced until done
+        self.closing: Set[asyncio.Task] = set()
+
+    def get(self, session_id: str | None = None) -> Session:
+        """The session with session_id, or a new one if it does not exist (anymore)."""
+        session = self.sessions.get(session_id) if session_id else None
+        if session is None:
+            self.evict(reserve=1)
+            session = Session(session_id or uuid.uuid4().hex, self.make_history())
+            self.sessions[session.session_id] = session
+        self.sessions.move_to_end(session.session_id)
+        session.last_used = time.monotonic()
+        return session
+
+    @contextmanager
+    def use(self, session_id: str | None = None):
+        """get the session and keep it from being evicted until the block exits."""
+        session = self.get(session_id)
+        session.users += 1
+        try:
+            yield session
+        finally:
+            session.users -= 1
+            session.last_used = time.monotonic()
+
+    def drop(self, session_id: str) -> bool:
+        session = self.sessions.pop(session_id, None)
+        if session is not None:
+            task = asyncio.create_task(session.chat_history.aclose())
+            self.closing.add(task)
+            task.add_done_callback(self.closing.discard)
+        return session is not None
+
+    def evict(self, reserve: int = 0) -> int:
+        """Drop expired sessions and the least recently used ones beyond max_sessions
+        minus reserve. Sessions in use are kept.
+        """
+        now = time.monotonic()
+        expired = [
+            session_id
+            for session_id, session in self.sessions.items()
+            if now - session.last_used > self.ttl_seconds and not session.users
+        ]
+        for session_id in expired:
+            self.drop(session_id)
+        removed = len(expired)
+        for session_id, session in list(self.sessions.items()):
+            if len(self.sessions) <= self.max_sessions - reserve:
+                break
+            if not session.users:
+                removed += self.drop(session_id)
+        return removed
+
+
+SESSIONS = web.AppKey("sessions", SessionStore)
+
+
+async def evict_periodically(app: web.Application):
+    async def loop():
+        while True:
+            await asyncio.sleep(60)
+            app[SESSIONS].evict()
+
+    task = asyncio.create_task(loop())
+    yield
+    task.cancel()
+
+
+async def answer(app: web.Application, session: Session, question: str, on_chunk):
+    async with session.lock, app[TURNS]:
+        try:
+            return await answer_question(
+                question, session.chat_history, on_chunk=on_chunk, **app[SETTINGS]
+            )
+        except Exception as e:
+            # the response may already be streaming, so answer rather than fail
+            print(f"Session {session.session_id}: answering '{question}' failed: {e!r}")
+            response = "Sorry, something went wrong, please ask again."
+            await on_chunk(response)
+            return response
+
+
+def parse_question(body) -> str:
+    """The question of a request body, raising ValueError if there is none."""
+    question = body.get("question") if isinstance(body, dict) else None
+    if not isinstance(question, str) or not question.strip():
+        raise ValueError("Missing question")
+    return question.strip()
+
+
+async def chat(request: web.Request) -> web.StreamResponse:
+    try:
+        body = await request.json()
+        question = parse_question(body)
+    except ValueError as e:
+        # json.JSONDecodeError is a ValueError
+        raise web.HTTPBadRequest(text=str(e))
+    session_id = body.get("session_id")
+    if session_id is not None and not isinstance(session_id, str):
+        raise web.HTTPBadRequest(text="session_id must be a string")
+    with request.app[SESSIONS].use(session_id) as session:
+        response = web.StreamResponse(
+            headers={
+                "Content-Type": "text/plain; charset=utf-8",
+                "X-Session-Id": session.session_id,
+            }
+        )
+        await response.prepare(request)
+
+        async def send(chunk: str):
+            await response.write(chunk.encode("utf-8"))
+
+        await answer(request.app, session, question, send)
+        await response.write_eof()
+    return response
+
+
+async def websocket(request: web.Request) -> web.WebSocketResponse:
+    ws = web.WebSocketResponse(heartbeat=30)
+    await ws.prepare(request)
+
+    async def send(chunk: str):
+        await ws.send_json({"type": "chunk", "text": chunk})
+
+    with request.app[SESSIONS].use(request.query.get("session_id")) as session:
+        await ws.send_json({"type": "session", "session_id": session.session_id})
+        async for message in ws:
+            if message.type != WSMsgType.TEXT:
+                continue
+            try:
+                question = parse_question(message.json())
+            except ValueError as e:
+                await ws.send_json({"type": "error", "error": str(e)})
+                continue
+            response = await answer(request.app, session, question, send)
+            await ws.send_json({"type": "done", "response": response})
+    return ws
+
+
+async def delete_session(request: web.Request) -> web.Response:
+    if not request.app[SESSIONS].drop(request.match_info["session_id"]):
+        raise web.HTTPNotFound()
+    return web.json_response({"deleted": request.match_info["session_id"]})
+
+
+async def health(request: web.Request) -> web.Response:
+    pipeline = request.app[SETTINGS]["pipeline"]
+    latencies: Dict = {}
+    if pipeline.client is not None:
+        stats = pipeline.client.stats
+        latencies = {
+            stage: {
+                "n": stats.count(stage),
+                "p50": stats.percentile(stage, 50),
+                "p95": stats.percentile(stage, 95),
+                "p99": stats.percentile(stage, 99),
+                "outcomes": dict(stats.outcomes.get(stage, {})),
+            }
+            for stage in list(stats.latencies)
+        }
+    batcher = retrieval.query_batcher
+    return web.json_response(
+        {
+            "sessions": len(request.app[SESSIONS].sessions),
+            "llm_latency": latencies,
+            "embedding_batches": batcher.stats.stats() if batcher is not None else None,
+        }
+    )
+
+
+def make_app(
+    settings: Dict,
+    max_sessions: int = 1000,
+    session_ttl: float = 3600,
+    max_concurrent_turns: int = 32,
+) -> web.Application:
+    """settings are bot.load_bot's, the history ones configure each session's."""
+    settings = dict(settings)
+    history_tokens = settings.pop("history_tokens")
+    history_turns = settings.pop("history_turns")
+    # turns run concurrently, each prints nothing (their lines would interleave) and
+    # streams to its client
+    settings["use_async"] = True
+    settings["stream_response"] = False
+    settings["verbose"] = 0
+    pipeline = settings["pipeline"]
+
+    app = web.Application()
+    app[SETTINGS] = settings
+    app[SESSIONS] = SessionStore(
+        lambda: ChatHistory(
+            pipeline.llm_for("summary"),
+            token_budget=history_tokens,
+            keep_turns=history_turns,
+        ),
+        max_sessions=max_sessions,
+        ttl_seconds=session_ttl,
+    )
+    app[TURNS] = asyncio.Semaphore(max_concurrent_turns)
+    app.cleanup_ctx.append(evict_periodically)
+    app.add_routes(
+        [
+            web.post("/chat", chat),
+            web.get("/ws", websocket),
+            web.delete("/sessions/{session_id}", delete_session),
+            web.get("/health", health),
+        ]
+    )
+    return app
+
+
+if __name__ == "__main__":
+    parser = build_arg_parser()
+    parser.description = "Serve the calendar bot over HTTP and WebSocket."
+    parser.add_argument("--host", default="0.0.0.0", type=str)
+    parser.add_argument("--port", default=8080, type=int)
+    parser.add_argument(
+        "--max_sessions",
+        default=1000,
+        type=int,
+        help="Sessions kept at most, the least recently used are dropped first.",
+    )
+    parser.add_argument(
+        "--session_ttl",
+        default=3600,
+        type=float,
+        help="Seconds after which an idle session is dropped.",
+    )
+    parser.add_argument(
+        "--max_concurrent_turns",
+        default=32,
+        type=int,
+        help="Questions answered at the same time, others wait for a slot.",
+    )
+
+    # concurrent sessions share embedding forward passes by default
+    parser.set_defaults(embed_batch_size=16)
+
+    timer = StartupTimer()
+    with timer.phase("parse arguments"):
+        args = parser.parse_args()
+    settings = load_bot(args, timer)
+
+    # every session embeds its questions, load the model before the first one
+    with timer.phase("load embedding model"):
+        retrieval.embedder.load()
+    if args.verbose > 2:
+        print(timer.report())
+
+    web.run_app(
+        make_app(
+            settings,
+            max_sessions=args.max_sessions,
+            session_ttl=args.session_ttl,
+            max_concurrent_turns=args.max_concurrent_turns,
+        ),
+        host=args.host,
+        port=args.port,
+    )
@@ -0,0 +1,83 @@
+"""Small helpers for timing the bot's startup and per-turn stages."""
+
+import threading
+import time
+from collections import Counter, deque
+from contextlib import contextmanager
+from typing import Dict, List, Tuple
+
+
+class StartupTimer:
+    """Records how long each named startup phase takes, in the order they ran."""
+
+    def __init__(self):
+        self.phases: List[Tuple[str, float]] = []
+
+    @contextmanager
+    def phase(self, name: str):
+        start_time = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.phases.append((name, time.perf_counter() - start_time))
+
+    @property
+    def total(self) -> float:
+        return sum(seconds for _, seconds in self.phases)
+
+    def report(self) -> str:
+        total = self.total
+        lines = ["Startup time breakdown:"]
+        for name, seconds in self.phases:
+            share = 100 * seconds / total if total else 0.0
+            lines.append(f"\t{name:<32} {seconds:8.3f} s  {share:5.1f}%")
+        lines.append(f"\t{'total':<32} {total:8.3f} s")
+        return "\n".join(lines)
+
+
+class LatencyStats:
+    """Latencies of the last `window` calls of each stage (e.g. 'intent', 'answer'),
+    with counts of how they ended (e.g. 'primary', 'hedge', 'fallback', 'timeout').
+    """
+
+    def __init__(self, window: int = 1000):
+        self.window = window
+        # a stage is only added by record, reading never creates an empty entry
+        self.latencies: Dict[str, deque] = {}
+        self.outcomes: Dict[str, Counter] = {}
+        self._lock = threading.Lock()
+
+    def record(self, stage: str, seconds: float, outcome: str = "primary"):
+        with self._lock:
+            self.latencies.setdefault(stage, deque(maxlen=self.window)).append(seconds)
+            self.outcomes.setdefault(stage, Counter())[outcome] += 1
+
+    def count(self, stage: str) -> int:
+        return len(self.latencies.get(stage, ()))
+
+    def percentile(self, stage: str, q: float) -> float | None:
+        with self._lock:
+            latencies = list(self.latencies.get(stage, ()))
+        if not latencies:
+            return None
+        # nearest rank, so small samples report latencies that actually happened
+        latencies.sort()
+        return latencies[min(len(latencies) - 1, int(q / 100 * len(latencies)))]
+
+    def report(self) -> str:
+        lines = ["LLM latency by stage:"]
+        with self._lock:
+            stages = sorted(self.latencies)
+        for stage in stages:
+            p50, p95, p99 = (self.percentile(stage, q) for q in (50, 95, 99))
+            if p50 is None:
+                continue
+            outcomes = ", ".join(
+                f"{outcome} {n}"
+                for outcome, n in sorted(self.outcomes.get(stage, {}).items())
+            )
+            lines.append(
+                f"\t{stage:<8} n={self.count(stage):<5d} p50 {p50:6.2f} s  "
+                f"p95 {p95:6.2f} s  p99 {p99:6.2f} s  ({outcomes})"
+            )
+        return "\n".join(lines)
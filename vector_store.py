@@ -0,0 +1,297 @@
+"""Vector search backends for the calendar embeddings.
+
+Every store answers get_nns_by_vector(vector, n, include_distances) the way an
+AnnoyIndex does: item i is row i of the embedding matrix (the index_id of the event),
+results are sorted by Annoy's angular distance sqrt(2 * (1 - cos)). retrieve_with_sbert
+can therefore use any of them:
+    - "numpy": exact search with one matrix-vector product, works directly on the
+      memory-mapped embedding matrix,
+    - "annoy": the approximate Annoy forest the bot has always used,
+    - "hnsw": an approximate HNSW graph (hnswlib), for very large calendars.
+
+select_backend picks one: calendars smaller than min_ann_items always use exact numpy
+search, larger ones run a short benchmark and pick the fastest backend whose recall
+against exact search reaches target_recall.
+
+Every store also scores given rows exactly with distances(vector, rows), which
+retrieve_docs uses to rank only the events of a date window.
+"""
+
+import os
+import threading
+import time
+from typing import Dict, List, Tuple
+
+import numpy as np
+
+# below this many events exact search is about as fast as any index and always exact
+MIN_ANN_ITEMS = 2000
+
+
+def angular_distances(vectors: np.ndarray, query: np.ndarray, norms=None):
+    """Annoy's angular distance, sqrt(2 * (1 - cos)), between query and each row."""
+    if norms is None:
+        norms = np.linalg.norm(vectors, axis=1)
+    cosine = vectors @ query / np.maximum(norms * np.linalg.norm(query), 1e-12)
+    return np.sqrt(np.maximum(2.0 * (1.0 - cosine), 0.0))
+
+
+class VectorStore:
+    """Base class, subclasses implement _search and optionally save/load."""
+
+    name = None
+    # file the index is saved to inside a cache entry, None if there is nothing to save
+    index_file = None
+
+    def __init__(self, embeddings: np.ndarray):
+        self.embeddings = embeddings
+
+    def get_n_items(self) -> int:
+        return len(self.embeddings)
+
+    def get_nns_by_vector(self, vector, n: int, include_distances: bool = False):
+        vector = np.asarray(vector, dtype=np.float32)
+        n = min(n, self.get_n_items())
+        if n <= 0:
+            ids, distances = [], []
+        else:
+            ids, distances = self._search(vector, n)
+        if include_distances:
+            return ids, distances
+        return ids
+
+    def distances(self, vector: np.ndarray, rows=None) -> np.ndarray:
+        """Exact angular distance from vector to every row, or only to the given rows."""
+        if rows is None:
+            return angular_distances(self.embeddings, vector)
+        rows = np.asarray(rows, dtype=np.int64)
+        return angular_distances(self.embeddings[rows], vector)
+
+    def _search(self, vector: np.ndarray, n: int) -> Tuple[List[int], List[float]]:
+        raise NotImplementedError
+
+    def save(self, path: str):
+        pass
+
+
+class NumpyVectorStore(VectorStore):
+    """Exact search over the embedding matrix, which is only read (mmap friendly)."""
+
+    name = "numpy"
+
+    def __init__(self, embeddings: np.ndarray):
+        super().__init__(embeddings)
+        self.norms = np.linalg.norm(embeddings, axis=1)
+
+    @classmethod
+    def build(cls, embeddings: np.ndarray, **params):
+        return cls(embeddings)
+
+    @classmethod
+    def load(cls, path: str, embeddings: np.ndarray, **params):
+        return cls(embeddings)
+
+    def distances(self, vector: np.ndarray, rows=None) -> np.ndarray:
+        if rows is None:
+            return angular_distances(self.embeddings, vector, self.norms)
+        rows = np.asarray(rows, dtype=np.int64)
+        return angular_distances(self.embeddings[rows], vector, self.norms[rows])
+
+    def _search(self, vector, n):
+        distances = self.distances(vector)
+        if n < len(distances):
+            ids = np.argpartition(distances, n - 1)[:n]
+        else:
+            ids = np.arange(len(distances))
+        ids = ids[np.argsort(distances[ids], kind="stable")]
+        return ids.tolist(), distances[ids].tolist()
+
+
+class AnnoyVectorStore(VectorStore):
+    """Approximate search with an Annoy forest of n_trees trees."""
+
+    name = "annoy"
+    index_file = "index.ann"
+
+    def __init__(self, embeddings: np.ndarray, index):
+        super().__init__(embeddings)
+        self.index = index
+
+    @classmethod
+    def build(cls, embeddings: np.ndarray, n_trees: int = 10, **params):
+        from annoy import AnnoyIndex
+
+        index = AnnoyIndex(embeddings.shape[1], "angular")
+        for i, embedding in enumerate(embeddings):
+            index.add_item(i, embedding)
+        index.build(n_trees)
+        return cls(embeddings, index)
+
+    @classmethod
+    def load(cls, path: str, embeddings: np.ndarray, **params):
+        from annoy import AnnoyIndex
+
+        index = AnnoyIndex(embeddings.shape[1], "angular")
+        index.load(path)  # memory-mapped
+        return cls(embeddings, index)
+
+    def save(self, path: str):
+        self.index.save(path)
+
+    def _search(self, vector, n):
+        return self.index.get_nns_by_vector(vector, n, include_distances=True)
+
+
+class HNSWVectorStore(VectorStore):
+    """Approximate search with an hnswlib HNSW graph over cosine distance."""
+
+    name = "hnsw"
+    index_file = "index.hnsw"
+
+    def __init__(self, embeddings: np.ndarray, index, ef: int = 64):
+        super().__init__(embeddings)
+        self.index = index
+        self.ef = ef
+        self.index.set_ef(ef)
+        # set_ef is not safe to call while other threads query
+        self._ef_lock = threading.Lock()
+
+    @classmethod
+    def build(
+        cls,
+        embeddings: np.ndarray,
+        m: int = 16,
+        ef_construction: int = 200,
+        ef: int = 64,
+        **params,
+    ):
+        import hnswlib
+
+        index = hnswlib.Index(space="cosine", dim=embeddings.shape[1])
+        index.init_index(
+            max_elements=max(len(embeddings), 1), M=m, ef_construction=ef_construction
+        )
+        if len(embeddings):
+            index.add_items(np.asarray(embeddings), np.arange(len(embeddings)))
+        return cls(embeddings, index, ef=ef)
+
+    @classmethod
+    def load(cls, path: str, embeddings: np.ndarray, ef: int = 64, **params):
+        import hnswlib
+
+        index = hnswlib.Index(space="cosine", dim=embeddings.shape[1])
+        index.load_index(path, max_elements=max(len(embeddings), 1))
+        return cls(embeddings, index, ef=ef)
+
+    def save(self, path: str):
+        self.index.save_index(path)
+
+    def _search(self, vector, n):
+        with self._ef_lock:
+            # ef must be at least the number of neighbours asked for
+            if n > self.ef:
+                self.ef = n
+                self.index.set_ef(n)
+            labels, cosine_distances = self.index.knn_query(vector, k=n)
+        distances = np.sqrt(np.maximum(2.0 * cosine_distances[0], 0.0))
+        return labels[0].tolist(), distances.tolist()
+
+
+BACKENDS = {
+    store.name: store for store in (NumpyVectorStore, AnnoyVectorStore, HNSWVectorStore)
+}
+
+
+def build_vector_store(embeddings: np.ndarray, backend: str = "annoy", **params):
+    """Build a store of the given backend over embeddings."""
+    return BACKENDS[backend].build(embeddings, **params)
+
+
+def load_vector_store(
+    backend: str, directory: str, embeddings: np.ndarray, **params
+) -> VectorStore | None:
+    """Load a store saved in directory, None if its index file is missing."""
+    store_class = BACKENDS[backend]
+    path = os.path.join(directory, store_class.index_file or "")
+    if store_class.index_file and not os.path.exists(path):
+        return None
+    return store_class.load(path, embeddings, **params)
+
+
+def benchmark_backends(
+    embeddings: np.ndarray,
+    backends: List[str] = ("numpy", "annoy", "hnsw"),
+    n: int = 10,
+    n_queries: int = 100,
+    seed: int = 0,
+) -> Dict[str, Dict]:
+    """Build each backend over embeddings and measure its build time, mean query time
+    and recall@n against exact search. Queries are corpus rows with a little noise, so
+    they look like new text about existing events. Backends whose library is not
+    installed are left out.
+    """
+    rng = np.random.default_rng(seed)
+    rows = rng.choice(
+        len(embeddings), size=min(n_queries, len(embeddings)), replace=False
+    )
+    noise = rng.normal(
+        scale=0.1 * float(np.std(embeddings)), size=(len(rows), embeddings.shape[1])
+    )
+    queries = (np.asarray(embeddings[rows]) + noise).astype(np.float32)
+
+    exact = NumpyVectorStore(embeddings)
+    truth = [set(exact.get_nns_by_vector(query, n)) for query in queries]
+
+    results = {}
+    for backend in backends:
+        try:
+            start_time = time.perf_counter()
+            store = build_vector_store(embeddings, backend)
+            build_seconds = time.perf_counter() - start_time
+        except ImportError:
+            continue
+        start_time = time.perf_counter()
+        found = [store.get_nns_by_vector(query, n) for query in queries]
+        query_seconds = (time.perf_counter() - start_time) / len(queries)
+        recall = np.mean(
+            [
+                len(truth_ids & set(ids)) / len(truth_ids)
+                for truth_ids, ids in zip(truth, found)
+            ]
+        )
+        results[backend] = {
+            "store": store,
+            "build_seconds": build_seconds,
+            "query_ms": 1000 * query_seconds,
+            "recall": float(recall),
+        }
+    return results
+
+
+def select_backend(
+    embeddings: np.ndarray,
+    target_recall: float = 0.95,
+    min_ann_items: int = MIN_ANN_ITEMS,
+    verbose: bool = False,
+) -> VectorStore:
+    """Pick and return a store for embeddings.
+    Small corpora get exact numpy search, larger ones the fastest benchmarked backend
+    reaching target_recall (numpy always qualifies with recall 1).
+    """
+    if len(embeddings) < min_ann_items:
+        if verbose:
+            print(f"Using exact numpy search for {len(embeddings)} events.")
+        return NumpyVectorStore(embeddings)
+
+    results = benchmark_backends(embeddings)
+    if verbose:
+        for backend, result in results.items():
+            print(
+                f"\t{backend:>6}: build {result['build_seconds']:.2f} s, "
+                f"query {result['query_ms']:.3f} ms, recall {result['recall']:.3f}"
+            )
+    eligible = [r for r in results.values() if r["recall"] >= target_recall]
+    best = min(eligible, key=lambda result: result["query_ms"])
+    if verbose:
+        print(f"Using {best['store'].name} search for {len(embeddings)} events.")
+    return best["store"]